@@ -1,22 +1,921 @@
-from flask import Flask, request, jsonify, render_template_string, redirect, session
+from flask import Flask, request, jsonify, render_template, stream_template, redirect, session
+from jinja2 import DictLoader, FileSystemBytecodeCache
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
 import uuid
-from datetime import datetime
+import json
+import copy
+import hashlib
+from datetime import datetime, timedelta
 import os
+from urllib.parse import urlencode
+import threading
+import atexit
+import gzip
+import heapq
+import bisect
+import itertools
+import queue
+import time
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from sqlalchemy import bindparam, event, inspect, text, update
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import IntegrityError
+from werkzeug.http import is_resource_modified
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+try:
+    import brotli  # optional: enables Content-Encoding: br
+except ImportError:
+    brotli = None
+
+try:
+    import orjson  # optional: faster JSON encoding for the /api/v1 endpoints
+except ImportError:
+    orjson = None
+
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app)
 CORS(app)
 
-# Database configuration
+# Database configuration; DATABASE_URL points the app at another database
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'exposed_instances.db')
+database_url = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'exposed_instances.db'))
+if database_url.startswith('postgres://'):
+    database_url = 'postgresql://' + database_url[len('postgres://'):]  # SQLAlchemy needs the long scheme
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['DB_POOL_SIZE'] = 16                # pooled (mostly read) connections per process
+app.config['SQLITE_BUSY_TIMEOUT'] = 10         # seconds to wait for another process's write lock
+app.config['WRITER_BATCH_SIZE'] = 64           # queued writes committed in one transaction
+app.config['WRITER_QUEUE_SIZE'] = 10000        # pending writes before callers block
+IS_SQLITE = database_url.startswith('sqlite')
+if IS_SQLITE:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': QueuePool,
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_POOL_SIZE'],
+        'connect_args': {'check_same_thread': False, 'timeout': app.config['SQLITE_BUSY_TIMEOUT']},
+    }
 db = SQLAlchemy(app)
 
+class DatabaseWriter:
+    """Single thread that performs every database write of this process
+
+    Writes are submitted as jobs: functions run in the writer's own app
+    context against db.session. Jobs waiting in the queue are run together,
+    each inside a savepoint so a failing job only undoes itself, and
+    committed in one transaction (up to batch_size jobs). Each job's return
+    value or exception is handed back through a Future once the commit is
+    done.
+
+    With one writer per process, request threads never contend for the
+    SQLite write lock among themselves and never hold it while they render;
+    in WAL mode they read without waiting on the writer. Writes from other
+    processes are waited out by busy_timeout.
+    """
+
+    def __init__(self, batch_size=64, queue_size=10000):
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def is_writer_thread(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) and return a Future for its result"""
+        future = Future()
+        if self.is_writer_thread():
+            # A job writing more: run it inside the current transaction
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        if self._ensure_thread():
+            self._queue.put((future, fn, args, kwargs))
+        else:
+            self._write([(future, fn, args, kwargs)])
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        """Run fn on the writer and wait for the commit; re-raises its exception"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def _ensure_thread(self):
+        """Start the writer if needed; False if no thread can be started (at exit)"""
+        # Started lazily so pre-forked workers each get their own thread
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                try:
+                    thread.start()
+                except RuntimeError:
+                    return False
+                self._thread = thread
+            return True
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        outcomes = []
+        with app.app_context():
+            for future, fn, args, kwargs in batch:
+                try:
+                    with db.session.begin_nested():
+                        outcomes.append((future, True, fn(*args, **kwargs)))
+                except Exception as e:
+                    outcomes.append((future, False, e))
+            try:
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error committing {len(batch)} queued writes: {e}")
+                outcomes = [(future, False, e) for future, _, _ in outcomes]
+        for future, ok, value in outcomes:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+db_writer = DatabaseWriter(
+    batch_size=app.config['WRITER_BATCH_SIZE'],
+    queue_size=app.config['WRITER_QUEUE_SIZE']
+)
+
+if IS_SQLITE:
+    with app.app_context():
+        sqlite_engine = db.engine
+
+    @event.listens_for(sqlite_engine, 'connect')
+    def configure_sqlite(dbapi_connection, connection_record):
+        # WAL lets readers run alongside the writer; NORMAL only syncs at
+        # checkpoints, which is safe in WAL mode (a power loss can drop the
+        # last commits, never corrupt the file)
+        dbapi_connection.isolation_level = None  # transactions are begun in begin_sqlite
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT'] * 1000)}")
+        cursor.close()
+
+    @event.listens_for(sqlite_engine, 'begin')
+    def begin_sqlite(connection):
+        # The writer takes the write lock up front, so its transactions never
+        # fail halfway when upgrading from a read lock
+        connection.exec_driver_sql('BEGIN IMMEDIATE' if db_writer.is_writer_thread() else 'BEGIN')
+
+# Upstream connection pool configuration
+app.config['UPSTREAM_POOL_CONNECTIONS'] = 4    # connection pools kept per instance session
+app.config['UPSTREAM_POOL_MAXSIZE'] = 10       # keep-alive connections kept per instance
+app.config['UPSTREAM_POOL_BLOCK'] = False      # wait for a free connection instead of opening an extra one
+app.config['UPSTREAM_MAX_POOLS'] = 500         # instances with an open pool at any time
+app.config['UPSTREAM_IDLE_TIMEOUT'] = 120      # seconds before an unused pool is closed
+app.config['UPSTREAM_WORKERS'] = 32            # threads issuing upstream calls for page handlers
+app.config['UPSTREAM_PAGE_DEADLINE'] = 5       # seconds a page waits for all of its upstream calls
+
+class UpstreamClient:
+    """Shared HTTP client for calls to local Atom instances
+
+    Keeps one keep-alive requests.Session per local_url so page views reuse
+    TCP/TLS connections instead of opening new ones. Pools that sit unused for
+    longer than idle_timeout are closed, and the least recently used pool is
+    dropped once more than max_pools instances have one open.
+    """
+
+    def __init__(self, pool_connections=4, pool_maxsize=10, pool_block=False,
+                 max_pools=500, idle_timeout=120):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.max_pools = max_pools
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()  # local_url -> (session, last_used), oldest first
+        self._lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+            max_retries=0
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Connection'] = 'keep-alive'
+        return session
+
+    def _evict_idle(self, now):
+        while self._sessions:
+            local_url, (session, last_used) = next(iter(self._sessions.items()))
+            if now - last_used <= self.idle_timeout:
+                break
+            del self._sessions[local_url]
+            session.close()
+
+    def session_for(self, local_url):
+        """Return the pooled session for local_url, creating it if needed"""
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._sessions.pop(local_url, None)
+            session = entry[0] if entry else self._new_session()
+            self._sessions[local_url] = (session, now)
+            while len(self._sessions) > self.max_pools:
+                _, (oldest, _) = self._sessions.popitem(last=False)
+                oldest.close()
+        return session
+
+    def get(self, local_url, path, **kwargs):
+        return self.session_for(local_url).get(f"{local_url}{path}", **kwargs)
+
+    def discard(self, local_url):
+        """Close the pool for local_url, e.g. after an instance moves or leaves"""
+        with self._lock:
+            entry = self._sessions.pop(local_url, None)
+        if entry:
+            entry[0].close()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'pools': len(self._sessions),
+                'idle_seconds': {
+                    url: round(now - last_used, 1)
+                    for url, (_, last_used) in self._sessions.items()
+                }
+            }
+
+upstream = UpstreamClient(
+    pool_connections=app.config['UPSTREAM_POOL_CONNECTIONS'],
+    pool_maxsize=app.config['UPSTREAM_POOL_MAXSIZE'],
+    pool_block=app.config['UPSTREAM_POOL_BLOCK'],
+    max_pools=app.config['UPSTREAM_MAX_POOLS'],
+    idle_timeout=app.config['UPSTREAM_IDLE_TIMEOUT']
+)
+upstream_executor = ThreadPoolExecutor(
+    max_workers=app.config['UPSTREAM_WORKERS'],
+    thread_name_prefix='upstream'
+)
+
+class SingleFlight:
+    """Coalesces concurrent upstream calls that share a key
+
+    The first caller for a key submits the work to the executor; callers that
+    arrive while it is still running get the same Future, so N viewers of one
+    page cause one upstream request and one DB write.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.coalesced = 0
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args, executor=None):
+        """Run fn(*args) on executor (default: the flight's), or join the call running for key"""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self._futures[key] = (executor or self.executor).submit(fn, *args)
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._futures)
+
+upstream_flights = SingleFlight(upstream_executor)
+
+# Circuit breaker configuration
+app.config['HEARTBEAT_TIMEOUT'] = 300          # seconds without a heartbeat before an instance is offline
+app.config['HEARTBEAT_FLUSH_INTERVAL'] = 5     # seconds between batched last_heartbeat writes (max loss on crash)
+app.config['HEARTBEAT_BATCH_MAX'] = 1000       # most heartbeats accepted in one /heartbeat/batch request
+app.config['LIVENESS_SWEEP_INTERVAL'] = 5      # seconds between expiry checks of the active set
+app.config['INSTANCE_RETENTION'] = None        # seconds offline before an instance is deleted; None keeps them
+app.config['REAP_INTERVAL'] = 3600             # seconds between removal runs
+app.config['INDEX_PAGE_SIZE'] = 60             # instances per index page
+app.config['INDEX_MAX_PAGE_SIZE'] = 500        # upper bound for ?limit= on index pages
+app.config['BREAKER_FAILURE_THRESHOLD'] = 3    # consecutive failed upstream calls that open the circuit
+app.config['BREAKER_SLOW_CALL_SECONDS'] = 2.5  # successful calls slower than this count as failures
+app.config['BREAKER_OPEN_SECONDS'] = 30        # how long an open circuit rejects calls before probing
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an instance whose circuit is open"""
+
+class CircuitBreaker:
+    """Tracks upstream health of one instance and short-circuits calls to it
+
+    The circuit opens after failure_threshold consecutive errors, timeouts or
+    slow calls, or as soon as the instance misses its heartbeats. While open,
+    calls are rejected without touching the network. After open_seconds (or
+    once heartbeats resume) a single half-open probe is let through: success
+    closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=3, slow_call_seconds=2.5, open_seconds=30,
+                 heartbeat_timeout=300):
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.heartbeat_timeout = heartbeat_timeout
+        self.state = 'closed'
+        self.reason = None
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.consecutive_failures = 0
+        self.counters = {'calls': 0, 'successes': 0, 'failures': 0, 'timeouts': 0,
+                         'slow_calls': 0, 'rejected': 0, 'opened': 0}
+        self.latency_ewma = None
+        self._lock = threading.Lock()
+
+    def _open(self, reason):
+        self.state = 'open'
+        self.reason = reason
+        self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+        self.counters['opened'] += 1
+
+    def allow(self, heartbeat_age=None):
+        """Return True if a call may go upstream now"""
+        missed_heartbeats = heartbeat_age is not None and heartbeat_age > self.heartbeat_timeout
+        with self._lock:
+            if self.state == 'closed' and missed_heartbeats:
+                self._open('heartbeat')
+            if self.state == 'open':
+                cooled_down = time.monotonic() - self.opened_at >= self.open_seconds
+                heartbeat_back = self.reason == 'heartbeat' and not missed_heartbeats
+                if not (cooled_down or heartbeat_back):
+                    self.counters['rejected'] += 1
+                    return False
+                self.state = 'half_open'
+            if self.state == 'half_open':
+                if self.probe_in_flight:
+                    self.counters['rejected'] += 1
+                    return False
+                self.probe_in_flight = True
+            self.counters['calls'] += 1
+            return True
+
+    def is_closed(self):
+        with self._lock:
+            return self.state == 'closed'
+
+    def record_success(self, latency):
+        if latency > self.slow_call_seconds:
+            self.record_failure('slow', latency)
+            return
+        with self._lock:
+            self._observe(latency)
+            self.counters['successes'] += 1
+            self.consecutive_failures = 0
+            if self.state == 'half_open':
+                self.state = 'closed'
+                self.reason = None
+            self.probe_in_flight = False
+
+    def record_failure(self, kind, latency):
+        """kind is 'error', 'timeout' or 'slow'"""
+        with self._lock:
+            self._observe(latency)
+            self.counters['failures'] += 1
+            if kind == 'timeout':
+                self.counters['timeouts'] += 1
+            elif kind == 'slow':
+                self.counters['slow_calls'] += 1
+            self.consecutive_failures += 1
+            if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+                self._open(kind)
+            self.probe_in_flight = False
+
+    def _observe(self, latency):
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * latency
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'reason': self.reason,
+                'consecutive_failures': self.consecutive_failures,
+                'latency_ewma_ms': round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+                **self.counters
+            }
+
+class BreakerRegistry:
+    """One CircuitBreaker per instance id, created on first use"""
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, instance_id):
+        with self._lock:
+            breaker = self._breakers.get(instance_id)
+            if breaker is None:
+                breaker = self._breakers[instance_id] = CircuitBreaker(**self.settings)
+            return breaker
+
+    def discard(self, instance_id):
+        with self._lock:
+            self._breakers.pop(instance_id, None)
+
+breakers = BreakerRegistry(
+    failure_threshold=app.config['BREAKER_FAILURE_THRESHOLD'],
+    slow_call_seconds=app.config['BREAKER_SLOW_CALL_SECONDS'],
+    open_seconds=app.config['BREAKER_OPEN_SECONDS'],
+    heartbeat_timeout=app.config['HEARTBEAT_TIMEOUT']
+)
+
+def upstream_request(instance, path, **kwargs):
+    """GET path from the instance through its pooled session and circuit breaker
+
+    Raises CircuitOpenError without any network I/O while the circuit is open.
+    """
+    breaker = breakers.get(instance.id)
+    heartbeat_age = (datetime.utcnow() - instance.last_heartbeat).total_seconds()
+    if not breaker.allow(heartbeat_age):
+        raise CircuitOpenError(f"Circuit open for {instance.username}")
+    started = time.monotonic()
+    try:
+        response = upstream.get(instance.local_url, path, **kwargs)
+    except requests.Timeout:
+        breaker.record_failure('timeout', time.monotonic() - started)
+        raise
+    except Exception:
+        breaker.record_failure('error', time.monotonic() - started)
+        raise
+    if response.status_code >= 500:
+        breaker.record_failure('error', time.monotonic() - started)
+    else:
+        breaker.record_success(time.monotonic() - started)
+    return response
+
+# File download proxy configuration
+app.config['DOWNLOAD_CHUNK_SIZE'] = 64 * 1024   # bytes relayed per read
+app.config['DOWNLOAD_MAX_CONCURRENT'] = 4       # simultaneous downloads per instance
+app.config['DOWNLOAD_CONNECT_TIMEOUT'] = 3
+app.config['DOWNLOAD_READ_TIMEOUT'] = 30        # max seconds between chunks from the instance
+DOWNLOAD_FORWARD_HEADERS = ('Range', 'If-Range')
+DOWNLOAD_RELAY_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges',
+                          'Content-Disposition', 'ETag', 'Last-Modified')
+
+class DownloadSlots:
+    """Per-instance cap on concurrent file downloads
+
+    A download holds a worker thread and an upstream connection for as long
+    as the client keeps reading, so each instance gets a fixed number of
+    slots and further requests are turned away instead of queueing.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._active = {}  # instance_id -> downloads in progress
+        self._lock = threading.Lock()
+
+    def acquire(self, instance_id):
+        with self._lock:
+            active = self._active.get(instance_id, 0)
+            if active >= self.limit:
+                return False
+            self._active[instance_id] = active + 1
+            return True
+
+    def release(self, instance_id):
+        with self._lock:
+            active = self._active.get(instance_id, 0) - 1
+            if active > 0:
+                self._active[instance_id] = active
+            else:
+                self._active.pop(instance_id, None)
+
+    def active(self, instance_id):
+        with self._lock:
+            return self._active.get(instance_id, 0)
+
+download_slots = DownloadSlots(app.config['DOWNLOAD_MAX_CONCURRENT'])
+
+# Response compression configuration
+app.config['COMPRESS_MIN_SIZE'] = 1024         # bytes; smaller bodies are sent as they are
+app.config['COMPRESS_GZIP_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/plain', 'application/json'}
+
+def preferred_encoding():
+    """Content coding to compress the current response with: 'br', 'gzip' or None"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+# Snapshot cache configuration (seconds)
+app.config['SNAPSHOT_TTLS'] = {        # served straight from memory while younger than this
+    'home_data': 30,
+    'files_data': 15,
+    'behaviors_data': 60,
+}
+app.config['SNAPSHOT_STALE_LIMIT'] = 600       # older entries are refetched before being served
+app.config['SNAPSHOT_TOUCH_INTERVAL'] = 60     # min seconds between DB writes confirming an unchanged snapshot
+app.config['SNAPSHOT_CACHE_MAX_ENTRIES'] = 5000
+app.config['DIRECTORY_CACHE_MAX_ENTRIES'] = 200  # folders kept in the DB per instance
+
+# File explorer listing configuration
+app.config['FILES_PAGE_SIZE'] = 200            # entries per listing page
+app.config['FILES_MAX_PAGE_SIZE'] = 1000       # upper bound for ?limit= on listings
+app.config['FILES_STREAM_THRESHOLD'] = 500     # pages with more rows are streamed
+LISTING_SORT_KEYS = ('name', 'size', 'modified')
+
+class SnapshotCache:
+    """In-memory stale-while-revalidate cache of instance snapshots
+
+    Entries younger than their endpoint's TTL are served as they are. Older
+    entries are still served, up to stale_limit seconds, while a background
+    refresh (coalesced by upstream_flights) brings them up to date.
+    """
+
+    Entry = namedtuple('Entry', ['data', 'fetched_at', 'synced_at', 'content_hash', 'validators'])
+
+    def __init__(self, ttls, stale_limit=600, max_entries=5000, default_ttl=30):
+        self.ttls = ttls
+        self.stale_limit = stale_limit
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()  # key -> Entry, least recently used first
+        self._touched = {}  # key -> monotonic time sync time was last written to the DB
+        self._lock = threading.Lock()
+
+    def ttl(self, endpoint):
+        return self.ttls.get(endpoint, self.default_ttl)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, data, synced_at=None, content_hash=None, validators=None):
+        """Store data for key; synced_at in the past makes the entry that much older
+
+        validators holds the upstream 'etag' / 'last_modified' for conditional
+        refreshes.
+        """
+        now = datetime.utcnow()
+        synced_at = synced_at or now
+        fetched_at = time.monotonic() - max(0, (now - synced_at).total_seconds())
+        content_hash = content_hash or snapshot_digest(data)[1]
+        with self._lock:
+            self._entries[key] = self.Entry(data, fetched_at, synced_at, content_hash, validators or {})
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, instance_id):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == instance_id]:
+                del self._entries[key]
+            for key in [k for k in self._touched if k[0] == instance_id]:
+                del self._touched[key]
+
+    def should_touch(self, key, interval):
+        """True at most once per interval seconds per key, to throttle sync-time writes"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._touched.get(key, float('-inf')) < interval:
+                return False
+            self._touched[key] = now
+            return True
+
+
+SNAPSHOT_ENDPOINTS = ('home_data', 'files_data', 'behaviors_data')
+
+def listing_defaults():
+    return {'offset': 0, 'limit': app.config['FILES_PAGE_SIZE'], 'sort': 'name', 'order': 'asc'}
+
+def is_first_listing_page(params):
+    """True for a folder's default page, the one stored in DirectorySnapshot"""
+    defaults = listing_defaults()
+    return all(params.get(name, default) == default for name, default in defaults.items())
+
+def snapshot_key(instance_id, endpoint, params=None):
+    params = dict(params or {})
+    if endpoint == 'files_data':
+        # The default page of a folder shares its key with listings pushed by
+        # the instance, which carry only a path
+        for name, default in listing_defaults().items():
+            if params.get(name) == default:
+                del params[name]
+    return (instance_id, endpoint, tuple(sorted(params.items())))
+
+def listing_fetch_params(instance_id, params):
+    """Params to load a files_data window with
+
+    Instances that paginate get one cache entry per window. For those that
+    send the whole folder regardless, every window is served from the cached
+    full listing of the folder's first page instead of fetching and caching
+    the folder again for each offset and sort order.
+    """
+    if is_first_listing_page(params):
+        return params
+    first = {**params, **listing_defaults()}
+    entry = snapshot_cache.get(snapshot_key(instance_id, 'files_data', first))
+    if entry is not None and isinstance(entry.data, dict) and 'total' not in entry.data:
+        return first
+    return params
+
+snapshot_cache = SnapshotCache(
+    app.config['SNAPSHOT_TTLS'],
+    stale_limit=app.config['SNAPSHOT_STALE_LIMIT'],
+    max_entries=app.config['SNAPSHOT_CACHE_MAX_ENTRIES']
+)
+
+# JSON API configuration
+app.config['API_BODY_CACHE_MAX_ENTRIES'] = 2000  # encoded response bodies kept in memory
+
+def dumps_json(data):
+    """Encode data as compact UTF-8 JSON, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode()
+
+class EncodedBodyCache:
+    """LRU cache of encoded API response bodies
+
+    Keys start with the snapshot's content hash, so an entry can never be
+    served for data it was not built from; bodies of replaced snapshots
+    simply age out.
+    """
+
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_encode(self, key, encode):
+        with self._lock:
+            body = self._bodies.get(key)
+            if body is not None:
+                self._bodies.move_to_end(key)
+                return body
+        body = encode()
+        with self._lock:
+            self._bodies[key] = body
+            while len(self._bodies) > self.max_entries:
+                self._bodies.popitem(last=False)
+        return body
+
+api_bodies = EncodedBodyCache(max_entries=app.config['API_BODY_CACHE_MAX_ENTRIES'])
+
+# Access list cache configuration
+app.config['ACL_TTL'] = 60                     # seconds a fetched allowed_users list is trusted
+
+class AclCache:
+    """Per-instance allowed_users sets, refreshed by TTL or by heartbeat pushes
+
+    Instances can push their full list (allowed_users) or just an opaque
+    acl_version in the heartbeat payload. A pushed list replaces the cached
+    set right away; a version that differs from the cached one drops the set
+    so the next access check fetches it again.
+    """
+
+    Entry = namedtuple('Entry', ['users', 'version', 'fetched_at'])
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._entries = {}
+        self._pending_versions = {}  # instance_id -> version announced before the list was fetched
+        self._lock = threading.Lock()
+
+    def put(self, instance_id, users, version=None, age=0):
+        """Cache users; age is how many seconds ago the list was fetched"""
+        with self._lock:
+            pending = self._pending_versions.pop(instance_id, None)
+            self._entries[instance_id] = self.Entry(
+                frozenset(users), version or pending, time.monotonic() - age
+            )
+
+    def get(self, instance_id):
+        """Return the cached Entry, including expired ones, or None"""
+        with self._lock:
+            return self._entries.get(instance_id)
+
+    def is_fresh(self, entry):
+        return entry is not None and time.monotonic() - entry.fetched_at <= self.ttl
+
+    def lookup(self, instance_id, user_email):
+        """True/False from a fresh cached list, or None if it must be fetched"""
+        entry = self.get(instance_id)
+        if not self.is_fresh(entry):
+            return None
+        return acl_allows(entry.users, user_email)
+
+    def apply_push(self, instance_id, payload):
+        """Update the cache from allowed_users / acl_version in a heartbeat payload"""
+        version = payload.get('acl_version')
+        if 'allowed_users' in payload:
+            self.put(instance_id, payload['allowed_users'] or [], version)
+            return
+        if version is None:
+            return
+        with self._lock:
+            entry = self._entries.get(instance_id)
+            if entry is None or entry.version != version:
+                self._entries.pop(instance_id, None)
+                self._pending_versions[instance_id] = version
+
+    def holds(self, instance_id, payload):
+        """True if a pushed allowed_users / acl_version is what the cache already has"""
+        version = payload.get('acl_version')
+        with self._lock:
+            entry = self._entries.get(instance_id)
+            if 'allowed_users' in payload:
+                return entry is not None and entry.version == version \
+                    and entry.users == frozenset(payload['allowed_users'] or [])
+            if version is None:
+                return True
+            return (entry is not None and entry.version == version) \
+                or self._pending_versions.get(instance_id) == version
+
+    def invalidate(self, instance_id):
+        with self._lock:
+            self._entries.pop(instance_id, None)
+            self._pending_versions.pop(instance_id, None)
+
+def acl_allows(allowed_users, user_email):
+    # If no allowed users set, allow all access
+    return not allowed_users or user_email in allowed_users
+
+acl_cache = AclCache(ttl=app.config['ACL_TTL'])
+
+# Behaviors view configuration
+app.config['BEHAVIORS_INITIAL_DEPTH'] = 1      # levels of the document rendered with the page
+app.config['BEHAVIORS_NODE_MAX_CHILDREN'] = 100  # children listed per node and request
+app.config['BEHAVIORS_VALUE_MAX_CHARS'] = 200  # longer strings are cut in the tree
+
+# File search configuration
+app.config['SEARCH_MAX_RESULTS'] = 50
+app.config['SEARCH_MAX_ENTRIES'] = 200000      # indexed names per instance
+
+class FileSearchIndex:
+    """Per-instance trigram index over the names in stored directory listings
+
+    Every stored folder listing is indexed under its path; replacing a folder
+    only re-indexes the names that were added or removed. Names are indexed
+    with start/end markers, so a query of three or more characters matches
+    anywhere in a name and two-character queries match name prefixes.
+    Instances are loaded from DirectorySnapshot rows on first use (see
+    ensure_search_index), which keeps search working while they are offline.
+    """
+
+    Entry = namedtuple('Entry', ['path', 'name', 'kind', 'size', 'modified'])
+
+    def __init__(self, max_entries=200000):
+        self.max_entries = max_entries
+        self._folders = {}  # instance_id -> {folder path: {entry path: Entry}}
+        self._grams = {}    # instance_id -> {trigram: set of entry paths}
+        self._entries = {}  # instance_id -> {entry path: Entry}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @classmethod
+    def _name_grams(cls, name):
+        return cls._trigrams('\x02' + name.lower() + '\x03')
+
+    def is_loaded(self, instance_id):
+        with self._lock:
+            return instance_id in self._entries
+
+    def load(self, instance_id, listings):
+        """Index an instance from (folder path, files_data) pairs"""
+        with self._lock:
+            self._folders[instance_id] = {}
+            self._grams[instance_id] = {}
+            self._entries[instance_id] = {}
+            for folder, data in listings:
+                self._replace(instance_id, folder, data)
+
+    def update_directory(self, instance_id, folder, data):
+        """Re-index one folder of an already loaded instance"""
+        with self._lock:
+            if instance_id in self._entries:
+                self._replace(instance_id, folder, data)
+
+    def remove_directory(self, instance_id, folder):
+        self.update_directory(instance_id, folder, None)
+
+    def forget(self, instance_id):
+        with self._lock:
+            self._folders.pop(instance_id, None)
+            self._grams.pop(instance_id, None)
+            self._entries.pop(instance_id, None)
+
+    def _replace(self, instance_id, folder, data):
+        structure = (data or {}).get('structure') or {}
+        prefix = folder + '/' if folder else ''
+        new = {}
+        for kind, items in (('folder', structure.get('folders', [])), ('file', structure.get('files', []))):
+            for item in items:
+                name = item.get('name')
+                if name:
+                    path = prefix + name
+                    new[path] = self.Entry(path, name, kind, item.get('size'), item.get('modified'))
+
+        folders = self._folders[instance_id]
+        grams = self._grams[instance_id]
+        entries = self._entries[instance_id]
+        old = folders.pop(folder, {})
+        for path, entry in old.items():
+            if new.get(path, entry) != entry or path not in new:
+                for gram in self._name_grams(entry.name):
+                    paths = grams.get(gram)
+                    if paths is not None:
+                        paths.discard(path)
+                        if not paths:
+                            del grams[gram]
+                entries.pop(path, None)
+        for path, entry in new.items():
+            if old.get(path) == entry:
+                continue
+            if len(entries) >= self.max_entries:
+                break
+            entries[path] = entry
+            for gram in self._name_grams(entry.name):
+                grams.setdefault(gram, set()).add(path)
+        if new:
+            folders[folder] = {path: entries[path] for path in new if path in entries}
+
+    def search(self, instance_id, query, limit=50):
+        """Return up to limit entries whose name contains query, prefix matches first"""
+        query = query.lower()
+        with self._lock:
+            entries = self._entries.get(instance_id, {})
+            grams = self._grams.get(instance_id, {})
+            if len(query) >= 3:
+                wanted = self._trigrams(query)
+            elif len(query) == 2:
+                wanted = self._trigrams('\x02' + query)
+            else:
+                wanted = None
+            if wanted is None:
+                candidates = [e for e in entries.values() if e.name.lower().startswith(query)]
+            else:
+                # The rarest trigram bounds the candidates; checking the name
+                # directly is cheaper than intersecting the larger sets
+                rarest = min((grams.get(gram, ()) for gram in wanted), key=len)
+                candidates = [entries[path] for path in rarest]
+        matches = (e for e in candidates if query in e.name.lower())
+        return heapq.nsmallest(
+            limit, matches,
+            key=lambda e: (not e.name.lower().startswith(query), len(e.name), e.path)
+        )
+
+file_search = FileSearchIndex(max_entries=app.config['SEARCH_MAX_ENTRIES'])
+
+StoredSnapshot = namedtuple('StoredSnapshot', ['data', 'synced_at', 'content_hash', 'validators'])
+
+# Result of fetch_local_snapshot. not_modified is True when the instance
+# answered 304 to our validators; data is None then
+UpstreamResult = namedtuple('UpstreamResult', ['data', 'is_fresh', 'not_modified', 'validators'])
+
+# Result of fetch_page_data. status is 'online' (fresh), 'stale' (cached copy
+# served while a refresh runs) or 'offline' (instance unreachable; any cached
+# copy is served as it is)
+PageData = namedtuple('PageData', ['allowed', 'data', 'status', 'synced_at', 'content_hash'])
+
+# Plain copy of the routing fields, safe to hand to upstream worker threads
+# (ORM objects are bound to the request's session and must stay on its thread)
+InstanceRef = namedtuple('InstanceRef', ['id', 'username', 'local_url', 'last_heartbeat'])
+
 # HTML Templates
 BASE_TEMPLATE = """
 <!DOCTYPE html>
@@ -48,28 +947,85 @@ BASE_TEMPLATE = """
     <div class="container mx-auto px-4 py-8">
         <h1 class="text-2xl font-bold mb-6">{{ title }}</h1>
         <div class="bg-white shadow-md rounded px-8 pt-6 pb-8 mb-4">
-            {{ content | safe }}
+            {% block content %}{% endblock %}
         </div>
         
-        {% if instance_status %}
-        <div class="mt-4 p-4 rounded {% if instance_status == 'online' %}bg-green-100{% else %}bg-yellow-100{% endif %}">
-            <p class="text-sm">
-                Instance Status: 
-                <span class="font-semibold">
-                    {% if instance_status == 'online' %}
-                        Online
-                    {% else %}
-                        Offline (showing cached data)
-                    {% endif %}
-                </span>
-            </p>
+        <div id="instance-status">
+            {% include "status_banner.html" %}
         </div>
-        {% endif %}
     </div>
+    
+    {% if live_section %}
+    <script>
+        // Live updates: server-sent events, falling back to polling when the
+        // server has no stream slots left
+        (function () {
+            var access = {{ access_args|tojson }};
+            var lastId = {{ last_event_id }};
+            function handle(type, data) {
+                if (type === 'status') {
+                    document.getElementById('instance-status').innerHTML = data.html;
+                } else if (type === 'section' && data.section === {{ live_section|tojson }}) {
+                    var target = document.getElementById('live-section');
+                    if (data.html !== undefined) {
+                        target.innerHTML = data.html;
+                    } else if (data.path === target.dataset.path) {
+                        document.getElementById('live-notice').classList.remove('hidden');
+                    }
+                }
+            }
+            function url(endpoint) {
+                var params = new URLSearchParams(access);
+                params.set('since', lastId);
+                return '/{{ username }}/' + endpoint + '?' + params;
+            }
+            function poll() {
+                fetch(url('events/poll')).then(function (r) { return r.json(); }).then(function (body) {
+                    (body.events || []).forEach(function (event) {
+                        lastId = event.id;
+                        handle(event.type, event.data);
+                    });
+                    setTimeout(poll, (body.retry || 0) * 1000);
+                }, function () { setTimeout(poll, 5000); });
+            }
+            if (!window.EventSource) { poll(); return; }
+            var source = new EventSource(url('events'));
+            ['status', 'section'].forEach(function (type) {
+                source.addEventListener(type, function (e) {
+                    lastId = parseInt(e.lastEventId, 10) || lastId;
+                    handle(type, JSON.parse(e.data));
+                });
+            });
+            source.onerror = function () {
+                if (source.readyState === EventSource.CLOSED) { poll(); }
+            };
+        })();
+    </script>
+    {% endif %}
 </body>
 </html>
 """
 
+# Instance status banner; also pushed on its own by the live update events
+STATUS_BANNER_TEMPLATE = """
+{% if instance_status %}
+<div class="mt-4 p-4 rounded {% if instance_status == 'online' %}bg-green-100{% elif instance_status == 'stale' %}bg-blue-100{% else %}bg-yellow-100{% endif %}">
+    <p class="text-sm">
+        Instance Status: 
+        <span class="font-semibold">
+            {% if instance_status == 'online' %}
+                Online
+            {% elif instance_status == 'stale' %}
+                Online (refreshing, showing data from {{ data_age }}s ago)
+            {% else %}
+                Offline (showing cached data)
+            {% endif %}
+        </span>
+    </p>
+</div>
+{% endif %}
+"""
+
 INDEX_TEMPLATE = """
 <!DOCTYPE html>
 <html>
@@ -82,6 +1038,12 @@ INDEX_TEMPLATE = """
     <div class="container mx-auto px-4 py-8">
         <h1 class="text-3xl font-bold mb-6">Active Atom Instances</h1>
         
+        <form method="GET" action="/" class="flex space-x-2 mb-6">
+            <input type="text" name="q" value="{{ prefix or '' }}" placeholder="Filter by username prefix"
+                   class="flex-grow px-3 py-2 border rounded">
+            <button type="submit" class="bg-blue-500 hover:bg-blue-600 text-white px-4 py-2 rounded">Filter</button>
+        </form>
+        
         {% if instances %}
             <div class="grid md:grid-cols-2 lg:grid-cols-3 gap-4">
                 {% for instance in instances %}
@@ -96,6 +1058,14 @@ INDEX_TEMPLATE = """
                     </div>
                 {% endfor %}
             </div>
+            {% if next_cursor %}
+            <div class="mt-6 text-center">
+                <a href="/?after={{ next_cursor | urlencode }}{% if prefix %}&q={{ prefix | urlencode }}{% endif %}"
+                   class="inline-block bg-white hover:bg-gray-50 text-blue-500 font-semibold py-2 px-4 rounded shadow">
+                    Next page
+                </a>
+            </div>
+            {% endif %}
         {% else %}
             <div class="bg-white rounded-lg shadow p-6">
                 <p class="text-gray-500">No active instances available.</p>
@@ -108,12 +1078,21 @@ INDEX_TEMPLATE = """
 
 # File explorer template
 FILE_EXPLORER_TEMPLATE = """
+{% macro sort_link(key, label, css) %}
+    <a href="{{ listing_url(sort=key, order='desc' if sort == key and order == 'asc' else 'asc', offset=0) }}"
+       class="{{ css }} hover:underline">
+        {{ label }}{% if sort == key %} <i class="fas fa-sort-{{ 'up' if order == 'asc' else 'down' }}"></i>{% endif %}
+    </a>
+{% endmacro %}
+
 <div class="mb-4">
     <div class="flex items-center space-x-2 mb-4">
         <div class="bg-gray-200 text-gray-700 px-3 py-1 rounded-md text-sm">
             / {{ current_path }}
         </div>
         <div class="flex-grow"></div>
+        <input id="file-search" type="search" placeholder="Search files"
+               class="border rounded px-3 py-1 text-sm" autocomplete="off">
         <button class="bg-blue-500 hover:bg-blue-600 text-white px-3 py-1 rounded text-sm">
             <i class="fas fa-upload mr-1"></i> Upload
         </button>
@@ -124,9 +1103,9 @@ FILE_EXPLORER_TEMPLATE = """
     
     <div class="bg-white border rounded-md">
         <div class="flex items-center justify-between px-4 py-2 bg-gray-50 border-b font-medium text-sm">
-            <div class="w-1/2">Name</div>
-            <div class="w-1/4 text-center">Size</div>
-            <div class="w-1/4 text-center">Modified</div>
+            {{ sort_link('name', 'Name', 'w-1/2') }}
+            {{ sort_link('size', 'Size', 'w-1/4 text-center') }}
+            {{ sort_link('modified', 'Modified', 'w-1/4 text-center') }}
         </div>
         
         {% if current_path != "" %}
@@ -140,31 +1119,376 @@ FILE_EXPLORER_TEMPLATE = """
         </div>
         {% endif %}
         
-        {% for item in file_data.folders %}
-        <div class="flex items-center px-4 py-2 border-b hover:bg-gray-50">
-            <div class="w-1/2 flex items-center">
-                <i class="fas fa-folder text-yellow-400 mr-2"></i>
-                <a href="/{{ username }}/files?path={{ current_path_prefix }}{{ item.name }}" class="hover:underline">{{ item.name }}</a>
-            </div>
-            <div class="w-1/4 text-center text-gray-500">-</div>
-            <div class="w-1/4 text-center text-gray-500">{{ item.modified }}</div>
+        <div id="file-rows">
+            {% include "file_rows.html" %}
+        </div>
+    </div>
+    
+    <div id="search-results" class="bg-white border rounded-md mt-2 hidden"></div>
+    <script>
+        (function () {
+            var input = document.getElementById('file-search');
+            var box = document.getElementById('search-results');
+            var timer = null;
+            var access = {{ access_args|tojson }};
+            function link(entry) {
+                var params = new URLSearchParams(access);
+                var parts = entry.path.split('/');
+                if (entry.kind === 'folder') {
+                    params.set('path', entry.path);
+                    return '/{{ username }}/files?' + params;
+                }
+                params.set('path', parts.slice(0, -1).join('/'));
+                return '/{{ username }}/files?' + params;
+            }
+            input.addEventListener('input', function () {
+                clearTimeout(timer);
+                var q = input.value.trim();
+                if (!q) { box.classList.add('hidden'); return; }
+                timer = setTimeout(function () {
+                    var params = new URLSearchParams(access);
+                    params.set('q', q);
+                    fetch('/{{ username }}/files/search?' + params).then(function (r) { return r.json(); }).then(function (body) {
+                        box.innerHTML = '';
+                        (body.results || []).forEach(function (entry) {
+                            var row = document.createElement('a');
+                            row.href = link(entry);
+                            row.className = 'block px-4 py-2 border-b hover:bg-gray-50 text-sm';
+                            row.textContent = entry.path;
+                            box.appendChild(row);
+                        });
+                        if (!box.children.length) box.textContent = 'No matches in folders seen so far';
+                        box.classList.remove('hidden');
+                    });
+                }, 150);
+            });
+        })();
+    </script>
+    
+    {% if next_offset is not none %}
+    <div class="mt-4 text-center" id="load-more-box">
+        <button id="load-more" data-url="{{ listing_url(offset=next_offset, rows=1) }}"
+                class="bg-white border hover:bg-gray-50 text-blue-500 px-4 py-2 rounded text-sm">
+            Load more ({{ total - next_offset }} remaining)
+        </button>
+    </div>
+    <script>
+        (function () {
+            var button = document.getElementById('load-more');
+            var loading = false;
+            function loadMore() {
+                if (loading || !button.dataset.url) return;
+                loading = true;
+                fetch(button.dataset.url).then(function (response) {
+                    var next = response.headers.get('X-Next-Url');
+                    return response.text().then(function (html) {
+                        document.getElementById('file-rows').insertAdjacentHTML('beforeend', html);
+                        if (next) {
+                            button.dataset.url = next;
+                            button.textContent = 'Load more (' + response.headers.get('X-Remaining') + ' remaining)';
+                        } else {
+                            document.getElementById('load-more-box').remove();
+                            observer.disconnect();
+                        }
+                        loading = false;
+                    });
+                });
+            }
+            button.addEventListener('click', loadMore);
+            var observer = new IntersectionObserver(function (entries) {
+                if (entries[0].isIntersecting) loadMore();
+            });
+            observer.observe(button);
+        })();
+    </script>
+    {% endif %}
+</div>
+"""
+
+# Rows of one listing page; also served on its own by /<username>/files/rows
+FILE_ROWS_TEMPLATE = """
+{% for kind, item in rows %}
+    {% if kind == 'folder' %}
+    <div class="flex items-center px-4 py-2 border-b hover:bg-gray-50">
+        <div class="w-1/2 flex items-center">
+            <i class="fas fa-folder text-yellow-400 mr-2"></i>
+            <a href="/{{ username }}/files?path={{ current_path_prefix }}{{ item.name }}" class="hover:underline">{{ item.name }}</a>
+        </div>
+        <div class="w-1/4 text-center text-gray-500">-</div>
+        <div class="w-1/4 text-center text-gray-500">{{ item.modified }}</div>
+    </div>
+    {% else %}
+    <div class="flex items-center px-4 py-2 border-b hover:bg-gray-50">
+        <div class="w-1/2 flex items-center">
+            <i class="{{ item.icon }} mr-2 text-gray-500"></i>
+            <a href="/{{ username }}/files/download?{{ dict(access_args, path=current_path_prefix ~ item.name)|urlencode }}"
+               class="hover:underline">{{ item.name }}</a>
         </div>
+        <div class="w-1/4 text-center text-gray-500">{{ item.size }}</div>
+        <div class="w-1/4 text-center text-gray-500">{{ item.modified }}</div>
+    </div>
+    {% endif %}
+{% endfor %}
+"""
+
+HOME_CONTENT_TEMPLATE = """
+{% macro key_grid(items, empty_message) %}
+    {% if items %}
+    <div class="grid grid-cols-2 gap-3">
+        {% for key in items %}
+        <div class="bg-gray-50 p-3 rounded">{{ key }}</div>
         {% endfor %}
-        
-        {% for item in file_data.files %}
-        <div class="flex items-center px-4 py-2 border-b hover:bg-gray-50">
-            <div class="w-1/2 flex items-center">
-                <i class="{{ item.icon }} mr-2 text-gray-500"></i>
-                <span>{{ item.name }}</span>
+    </div>
+    {% else %}
+    <div class="text-gray-500 italic">{{ empty_message }}</div>
+    {% endif %}
+{% endmacro %}
+
+{% macro sequence_list(sequences) %}
+    {% for seq_name, seq_data in sequences.items() %}
+    <div class="mb-4 last:mb-0">
+        <div class="font-medium text-lg mb-2">{{ seq_name }}</div>
+        <div class="bg-gray-50 p-4 rounded">
+            <div class="space-y-2">
+                {% for action in seq_data %}
+                <div class="flex items-center space-x-2">
+                    <span class="text-blue-500">
+                        <i class="fas fa-{{ 'code' if action['type'] == 'actions' else 'cog' }}"></i>
+                    </span>
+                    <span class="font-medium">{{ action['name'] }}</span>
+                </div>
+                {% endfor %}
             </div>
-            <div class="w-1/4 text-center text-gray-500">{{ item.size }}</div>
-            <div class="w-1/4 text-center text-gray-500">{{ item.modified }}</div>
         </div>
+    </div>
+    {% else %}
+    <div class="text-gray-500 italic">No sequences defined</div>
+    {% endfor %}
+{% endmacro %}
+
+<div class="space-y-6">
+    <div class="flex items-center space-x-4">
+        <div class="text-2xl font-bold text-gray-700">{{ data.get('name', username) }}'s Dashboard</div>
+    </div>
+    
+    <div class="grid grid-cols-1 md:grid-cols-2 gap-6">
+        <div class="bg-white p-6 rounded-lg shadow">
+            <h2 class="text-xl font-semibold mb-4 text-gray-700">
+                <i class="fas fa-plug mr-2"></i>Connections
+            </h2>
+            {{ key_grid(data.get('connections_data'), 'No connections configured') }}
+        </div>
+
+        <div class="bg-white p-6 rounded-lg shadow">
+            <h2 class="text-xl font-semibold mb-4 text-gray-700">
+                <i class="fas fa-cube mr-2"></i>Apps
+            </h2>
+            {{ key_grid(data.get('apps'), 'No apps installed') }}
+        </div>
+    </div>
+
+    <div class="bg-white p-6 rounded-lg shadow">
+        <h2 class="text-xl font-semibold mb-4 text-gray-700">
+            <i class="fas fa-code-branch mr-2"></i>Sequences
+        </h2>
+        {{ sequence_list(data.get('sequences') or {}) }}
+    </div>
+</div>
+"""
+
+BEHAVIORS_CONTENT_TEMPLATE = """
+{% macro node_label(node) %}
+    <span class="text-gray-400 text-sm">
+        {{ '{' if node.type == 'object' else '[' }}{{ node.size }} {{ 'keys' if node.type == 'object' else 'items' }}{{ '}' if node.type == 'object' else ']' }}
+    </span>
+{% endmacro %}
+
+{% macro render_children(node, path) %}
+    <ul class="ml-4 border-l pl-3 space-y-1 font-mono text-sm">
+        {% for child in node.children %}
+        {% set child_path = path ~ '/' ~ child.key|replace('~', '~0')|replace('/', '~1') %}
+        <li>
+            {% if child.type == 'value' %}
+                <span class="font-medium">{{ child.key }}</span>:
+                <span class="text-gray-600">{{ child.value }}{% if child.truncated %}&hellip;{% endif %}</span>
+            {% else %}
+                <button class="behavior-toggle text-blue-500 hover:underline" data-path="{{ child_path }}"
+                        data-loaded="{{ 'true' if child.children is not none else '' }}">
+                    <i class="fas fa-caret-{{ 'down' if child.children is not none else 'right' }}"></i> {{ child.key }}
+                </button>
+                {{ node_label(child) }}
+                <div class="behavior-children">
+                    {% if child.children is not none %}{{ render_children(child, child_path) }}{% endif %}
+                </div>
+            {% endif %}
+        </li>
         {% endfor %}
+        {% if node.more %}
+        <li>
+            <button class="behavior-more text-blue-500 hover:underline" data-path="{{ path }}"
+                    data-offset="{{ node.offset + node.children|length }}">Show {{ node.more }} more</button>
+        </li>
+        {% endif %}
+    </ul>
+{% endmacro %}
+
+<div class="space-y-4">
+    <div class="text-lg">Behaviors</div>
+    <div class="bg-gray-100 p-4 rounded overflow-auto" id="behaviors-tree">
+        {% if tree.type == 'value' %}
+            <span class="font-mono text-sm">{{ tree.value }}{% if tree.truncated %}&hellip;{% endif %}</span>
+        {% else %}
+            {{ node_label(tree) }}
+            {{ render_children(tree, '') }}
+        {% endif %}
     </div>
 </div>
 """
 
+# Expands behaviors subtrees from /<username>/behaviors/node; handlers are
+# delegated so they keep working when live updates replace the tree
+BEHAVIORS_SCRIPT_TEMPLATE = """
+<script>
+    (function () {
+        function escapePart(key) { return key.replace(/~/g, '~0').replace(/\\//g, '~1'); }
+        function el(tag, className, text) {
+            var node = document.createElement(tag);
+            if (className) node.className = className;
+            if (text !== undefined) node.textContent = text;
+            return node;
+        }
+        function label(node) {
+            return node.type === 'object' ? '{' + node.size + ' keys}' : '[' + node.size + ' items]';
+        }
+        function moreButton(path, offset, more) {
+            var li = el('li');
+            var button = el('button', 'behavior-more text-blue-500 hover:underline', 'Show ' + more + ' more');
+            button.dataset.path = path;
+            button.dataset.offset = offset;
+            li.appendChild(button);
+            return li;
+        }
+        function childItems(node, path) {
+            var items = [];
+            node.children.forEach(function (child) {
+                var li = el('li');
+                var childPath = path + '/' + escapePart(child.key);
+                if (child.type === 'value') {
+                    li.appendChild(el('span', 'font-medium', child.key));
+                    li.appendChild(document.createTextNode(': '));
+                    li.appendChild(el('span', 'text-gray-600', child.value + (child.truncated ? '\u2026' : '')));
+                } else {
+                    var button = el('button', 'behavior-toggle text-blue-500 hover:underline', ' ' + child.key);
+                    button.insertBefore(el('i', 'fas fa-caret-right'), button.firstChild);
+                    button.dataset.path = childPath;
+                    li.appendChild(button);
+                    li.appendChild(el('span', 'text-gray-400 text-sm', ' ' + label(child)));
+                    li.appendChild(el('div', 'behavior-children'));
+                }
+                items.push(li);
+            });
+            if (node.more) items.push(moreButton(path, node.offset + node.children.length, node.more));
+            return items;
+        }
+        function fetchNode(path, offset) {
+            var params = new URLSearchParams({path: path, offset: offset || 0});
+            return fetch('/{{ username }}/behaviors/node?' + params).then(function (r) { return r.json(); });
+        }
+        document.addEventListener('click', function (e) {
+            var toggle = e.target.closest('.behavior-toggle');
+            var more = e.target.closest('.behavior-more');
+            if (toggle) {
+                var box = toggle.parentNode.querySelector('.behavior-children');
+                var icon = toggle.querySelector('i');
+                if (toggle.dataset.loaded) {
+                    box.classList.toggle('hidden');
+                    icon.className = box.classList.contains('hidden') ? 'fas fa-caret-right' : 'fas fa-caret-down';
+                    return;
+                }
+                fetchNode(toggle.dataset.path).then(function (node) {
+                    var list = el('ul', 'ml-4 border-l pl-3 space-y-1 font-mono text-sm');
+                    childItems(node, toggle.dataset.path).forEach(function (li) { list.appendChild(li); });
+                    box.appendChild(list);
+                    toggle.dataset.loaded = 'true';
+                    icon.className = 'fas fa-caret-down';
+                });
+            } else if (more) {
+                fetchNode(more.dataset.path, more.dataset.offset).then(function (node) {
+                    var li = more.parentNode;
+                    childItems(node, more.dataset.path).forEach(function (item) { li.parentNode.insertBefore(item, li); });
+                    li.remove();
+                });
+            }
+        });
+    })();
+</script>
+"""
+
+ACCESS_REQUIRED_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Access Required</title>
+    <script src="https://cdn.tailwindcss.com"></script>
+</head>
+<body class="bg-gray-100">
+    <div class="container mx-auto px-4 py-8">
+        <div class="bg-white shadow-md rounded px-8 pt-6 pb-8 mb-4">
+            <h1 class="text-2xl font-bold mb-4">Access Required</h1>
+            <p class="mb-4">Please enter your email to access this instance:</p>
+            <form method="GET" class="space-y-4">
+                {% for key, value in hidden_args.items() %}
+                <input type="hidden" name="{{ key }}" value="{{ value }}">
+                {% endfor %}
+                <input type="email" name="email" placeholder="Enter your email" 
+                       class="w-full px-3 py-2 border rounded" required>
+                <button type="submit" 
+                        class="bg-blue-500 text-white px-4 py-2 rounded hover:bg-blue-600">
+                    Submit
+                </button>
+            </form>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+# Template registry: compiled once by app.jinja_env and cached as bytecode.
+# Page templates extend base.html and fill its content block.
+TEMPLATES = {
+    'base.html': BASE_TEMPLATE,
+    'index.html': INDEX_TEMPLATE,
+    'access_required.html': ACCESS_REQUIRED_TEMPLATE,
+    'file_explorer.html': FILE_EXPLORER_TEMPLATE,
+    'file_rows.html': FILE_ROWS_TEMPLATE,
+    'home_content.html': HOME_CONTENT_TEMPLATE,
+    'behaviors_content.html': BEHAVIORS_CONTENT_TEMPLATE,
+    'behaviors_script.html': BEHAVIORS_SCRIPT_TEMPLATE,
+    'status_banner.html': STATUS_BANNER_TEMPLATE,
+    'home.html': '{% extends "base.html" %}{% block content %}'
+                 '<div id="live-section">{% include "home_content.html" %}</div>{% endblock %}',
+    'files.html': '{% extends "base.html" %}{% block content %}'
+                  '<div id="live-notice" class="hidden mb-4 p-2 rounded bg-blue-100 text-sm">'
+                  'This folder changed. <a href="" class="text-blue-500 hover:underline">Reload</a></div>'
+                  '<div id="live-section" data-path="{{ current_path }}">{% include "file_explorer.html" %}</div>'
+                  '{% endblock %}',
+    'behaviors.html': '{% extends "base.html" %}{% block content %}'
+                      '<div id="live-section">{% include "behaviors_content.html" %}</div>'
+                      '{% include "behaviors_script.html" %}{% endblock %}',
+}
+
+app.config['TEMPLATE_BYTECODE_CACHE_DIR'] = None  # None uses the system temp directory
+app.jinja_options = {
+    **app.jinja_options,
+    'loader': DictLoader(TEMPLATES),
+    'bytecode_cache': FileSystemBytecodeCache(app.config['TEMPLATE_BYTECODE_CACHE_DIR']),
+}
+
+def check_templates():
+    """Compile every registered template, raising on the first syntax error"""
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+
 # Database Model
 class ExposedInstance(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -172,12 +1496,10 @@ class ExposedInstance(db.Model):
     username = db.Column(db.String(100), nullable=False, unique=True)
     local_url = db.Column(db.String(200), nullable=False)
     token = db.Column(db.String(100), unique=True, nullable=False)
-    last_heartbeat = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_heartbeat = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     
-    # Cached data
-    home_data = db.Column(db.JSON, nullable=True)
-    files_data = db.Column(db.JSON, nullable=True)
-    behaviors_data = db.Column(db.JSON, nullable=True)
+    # Cached payloads live in InstanceSnapshot / DirectorySnapshot so that
+    # routing and heartbeat queries only load this small row
     last_data_sync = db.Column(db.DateTime, nullable=True)
     
     def to_dict(self):
@@ -186,25 +1508,1192 @@ class ExposedInstance(db.Model):
             'username': self.username,
             'local_url': self.local_url,
             'token': self.token,
-            'last_heartbeat': self.last_heartbeat.isoformat()
+            'last_heartbeat': self.heartbeat_at().isoformat()
         }
     
+    def heartbeat_at(self):
+        """Latest heartbeat, including ones not yet flushed to the DB"""
+        seen = heartbeats.last_seen(self.id)
+        return max(seen, self.last_heartbeat) if seen else self.last_heartbeat
+
     def is_online(self):
-        return (datetime.utcnow() - self.last_heartbeat).total_seconds() <= 300
+        return liveness.is_online(self.id)
+
+    def ref(self):
+        return InstanceRef(self.id, self.username, self.local_url, self.heartbeat_at())
+
+class InstanceSnapshot(db.Model):
+    """Last known home_data / behaviors_data document of an instance"""
+    __table_args__ = (db.UniqueConstraint('instance_id', 'kind'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    instance_id = db.Column(db.Integer, db.ForeignKey('exposed_instance.id'), nullable=False, index=True)
+    kind = db.Column(db.String(32), nullable=False)
+    data = db.Column(db.JSON, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Validators from the local instance's response, sent back on the next fetch
+    upstream_etag = db.Column(db.String(200), nullable=True)
+    upstream_last_modified = db.Column(db.String(64), nullable=True)
+
+class DirectorySnapshot(db.Model):
+    """Last known files_data listing of one folder of an instance"""
+    __table_args__ = (db.UniqueConstraint('instance_id', 'path'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    instance_id = db.Column(db.Integer, db.ForeignKey('exposed_instance.id'), nullable=False, index=True)
+    path = db.Column(db.String(1024), nullable=False, default='')
+    data = db.Column(db.JSON, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False)
+    fetched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_access = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    upstream_etag = db.Column(db.String(200), nullable=True)
+    upstream_last_modified = db.Column(db.String(64), nullable=True)
+
+class SharedCacheEntry(db.Model):
+    """Cache entry or lease shared by all worker processes through the database"""
+    key = db.Column(db.String(255), primary_key=True)
+    value = db.Column(db.JSON, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=True, index=True)
+
+class CacheInvalidation(db.Model):
+    """Append-only log of cache invalidations, replayed by every worker process"""
+    id = db.Column(db.Integer, primary_key=True)
+    instance_id = db.Column(db.Integer, nullable=False)
+    scope = db.Column(db.String(32), nullable=False)   # 'acl', 'moved', 'removed' or 'snapshot'
+    origin = db.Column(db.String(64), nullable=False)  # process that wrote it
+    detail = db.Column(db.JSON)                        # which snapshot, for 'snapshot'
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+# Cross-process shared state
+app.config['INVALIDATION_POLL_INTERVAL'] = 2   # seconds between reads of the invalidation log
+app.config['INVALIDATION_RETENTION'] = 3600    # seconds invalidation rows are kept
+# Worker processes serving the app (gunicorn.conf.py sets it). Relays between
+# processes and refresh leases are skipped when there is only one.
+app.config['WORKER_PROCESSES'] = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+def multiple_processes():
+    return app.config['WORKER_PROCESSES'] > 1
+
+def shared_get(key):
+    """Return the unexpired SharedCacheEntry for key, or None"""
+    row = db.session.get(SharedCacheEntry, key)
+    if row is None or (row.expires_at is not None and row.expires_at <= datetime.utcnow()):
+        return None
+    return row
+
+def shared_put(key, value, ttl=None, updated_at=None):
+    """Upsert a shared entry; the caller commits"""
+    now = datetime.utcnow()
+    db.session.merge(SharedCacheEntry(
+        key=key, value=value, updated_at=updated_at or now,
+        expires_at=now + timedelta(seconds=ttl) if ttl else None
+    ))
+
+def shared_delete(key):
+    """Drop a shared entry; the caller commits"""
+    SharedCacheEntry.query.filter_by(key=key).delete(synchronize_session=False)
+
+def acquire_lease(name, seconds):
+    """Try to take a named lease for seconds; only one process can hold it
+
+    Used so that a single worker process refreshes a snapshot while the others
+    keep serving their cached copy. Waits for the write to commit.
+    """
+    def take():
+        now = datetime.utcnow()
+        key = f"lease:{name}"
+        SharedCacheEntry.query.filter(SharedCacheEntry.key == key, SharedCacheEntry.expires_at <= now) \
+            .delete(synchronize_session=False)
+        db.session.add(SharedCacheEntry(key=key, updated_at=now, expires_at=now + timedelta(seconds=seconds)))
+        db.session.flush()
+    try:
+        db_writer.run(take)
+        return True
+    except IntegrityError:
+        return False
+
+def release_lease(name):
+    db_writer.submit(shared_delete, f"lease:{name}")
+
+class InvalidationLog:
+    """Spreads cache invalidations between worker processes
+
+    Every process keeps its own in-memory caches. When one of them learns
+    that cached data of an instance is wrong (the instance moved, left, or
+    pushed a new access list) it appends a CacheInvalidation row; a
+    background thread in each process reads the rows written since its last
+    poll and drops the affected entries from its own caches. Stored snapshots
+    that changed are relayed the same way ('snapshot' rows), so every process
+    can update its search index and the tabs it streams to.
+    """
+
+    def __init__(self, poll_interval=2, retention=3600):
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.origin = uuid.uuid4().hex
+        self._last_id = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def broadcast(self, instance_id, scope, detail=None):
+        """Record an invalidation for the other processes; the caller commits"""
+        self.ensure_listening()
+        db.session.add(CacheInvalidation(instance_id=instance_id, scope=scope, origin=self.origin,
+                                         detail=detail))
+
+    def ensure_listening(self):
+        # Started lazily so pre-forked workers each get their own thread
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='invalidation-log', daemon=True)
+                self._thread.start()
+
+    def poll(self):
+        """Apply invalidations written by other processes since the last poll"""
+        with app.app_context():
+            if self._last_id is None:
+                # Rows older than this process describe caches it never had
+                self._last_id = db.session.query(db.func.max(CacheInvalidation.id)).scalar() or 0
+                return 0
+            rows = CacheInvalidation.query.filter(CacheInvalidation.id > self._last_id) \
+                .order_by(CacheInvalidation.id).all()
+            for row in rows:
+                self._last_id = row.id
+                if row.origin != self.origin:
+                    apply_invalidation(row.instance_id, row.scope, row.detail)
+            return len(rows)
+
+    def prune(self):
+        """Delete old invalidation rows and expired shared entries"""
+        def prune():
+            now = datetime.utcnow()
+            CacheInvalidation.query.filter(
+                CacheInvalidation.created_at < now - timedelta(seconds=self.retention)
+            ).delete(synchronize_session=False)
+            SharedCacheEntry.query.filter(SharedCacheEntry.expires_at < now) \
+                .delete(synchronize_session=False)
+        try:
+            db_writer.run(prune)
+        except Exception as e:
+            print(f"Error pruning shared cache: {e}")
+
+    def _run(self):
+        polls = 0
+        while True:
+            try:
+                self.poll()
+                polls += 1
+                if polls % max(1, int(600 / self.poll_interval)) == 0:
+                    self.prune()
+            except Exception as e:
+                print(f"Error reading invalidation log: {e}")
+            time.sleep(self.poll_interval)
+
+invalidations = InvalidationLog(
+    poll_interval=app.config['INVALIDATION_POLL_INTERVAL'],
+    retention=app.config['INVALIDATION_RETENTION']
+)
+
+def apply_invalidation(instance_id, scope, detail=None):
+    """Drop this process's cached state for an instance"""
+    if scope == 'snapshot':
+        adopt_relayed_snapshot(instance_id, detail['endpoint'], detail.get('path'))
+        return
+    acl_cache.invalidate(instance_id)
+    if scope == 'acl':
+        return
+    snapshot_cache.invalidate(instance_id)
+    breakers.discard(instance_id)
+    if scope == 'removed':
+        heartbeats.forget(instance_id)
+        liveness.forget(instance_id)
+        event_broker.forget(instance_id)
+        file_search.forget(instance_id)
+        folder_prefetcher.forget(instance_id)
+
+# Heartbeat recording
+class HeartbeatRecorder:
+    """Write-behind store for last_heartbeat
+
+    Plain heartbeats only update an in-memory timestamp; a background thread
+    writes all timestamps collected since the last run in one transaction every
+    flush_interval seconds, so a crash loses at most that much liveness
+    history. Tokens are resolved to instance ids from memory after the first
+    lookup. Every recorded heartbeat is also passed on to the liveness tracker.
+    """
+
+    def __init__(self, flush_interval=5):
+        self.flush_interval = flush_interval
+        self._pending = {}    # instance_id -> newest unflushed heartbeat
+        self._last_seen = {}  # instance_id -> newest heartbeat seen by this process
+        self._tokens = {}     # token -> instance_id
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def resolve_token(self, token):
+        """Return the instance id for token, or None if it is not registered"""
+        with self._lock:
+            instance_id = self._tokens.get(token)
+        if instance_id is None:
+            instance_id = db.session.query(ExposedInstance.id).filter_by(token=token).scalar()
+            if instance_id is not None:
+                with self._lock:
+                    self._tokens[token] = instance_id
+        return instance_id
+
+    def resolve_tokens(self, tokens):
+        """Return {token: instance_id} for the registered tokens, in at most one query"""
+        with self._lock:
+            found = {t: self._tokens[t] for t in tokens if t in self._tokens}
+        missing = [t for t in set(tokens) if t not in found]
+        if missing:
+            rows = db.session.query(ExposedInstance.token, ExposedInstance.id) \
+                .filter(ExposedInstance.token.in_(missing)).all()
+            with self._lock:
+                for token, instance_id in rows:
+                    self._tokens[token] = instance_id
+                    found[token] = instance_id
+        return found
+
+    def record(self, instance_id, at=None, persisted=False):
+        """Note a heartbeat; persisted=True when the caller already wrote it to the DB"""
+        at = at or datetime.utcnow()
+        with self._lock:
+            if at > self._last_seen.get(instance_id, datetime.min):
+                self._last_seen[instance_id] = at
+            if persisted:
+                if self._pending.get(instance_id, datetime.min) <= at:
+                    self._pending.pop(instance_id, None)
+            elif at > self._pending.get(instance_id, datetime.min):
+                self._pending[instance_id] = at
+            self._ensure_flusher()
+        liveness.beat(instance_id, at)
+
+    def last_seen(self, instance_id):
+        with self._lock:
+            return self._last_seen.get(instance_id)
+
+    def forget(self, instance_id):
+        with self._lock:
+            self._pending.pop(instance_id, None)
+            self._last_seen.pop(instance_id, None)
+            for token in [t for t, i in self._tokens.items() if i == instance_id]:
+                del self._tokens[token]
+
+    def flush(self):
+        """Write pending heartbeats in one transaction"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        def write():
+            # Never move last_heartbeat backwards past a value written directly
+            table = ExposedInstance.__table__
+            stmt = update(table) \
+                .where(table.c.id == bindparam('instance_id')) \
+                .where(table.c.last_heartbeat < bindparam('at')) \
+                .values(last_heartbeat=bindparam('at'))
+            db.session.execute(stmt, [
+                {'instance_id': instance_id, 'at': at} for instance_id, at in batch.items()
+            ])
+        try:
+            db_writer.run(write)
+        except Exception as e:
+            print(f"Error flushing heartbeats: {e}")
+            # Put the batch back unless newer heartbeats arrived meanwhile
+            with self._lock:
+                for instance_id, at in batch.items():
+                    if at > self._pending.get(instance_id, datetime.min):
+                        self._pending[instance_id] = at
+            return 0
+        return len(batch)
+
+    def _ensure_flusher(self):
+        # Started lazily so pre-forked workers each get their own thread
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='heartbeat-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+heartbeats = HeartbeatRecorder(flush_interval=app.config['HEARTBEAT_FLUSH_INTERVAL'])
+atexit.register(heartbeats.flush)
+
+class LivenessTracker:
+    """In-memory set of online instances, expired from a heap of deadlines
+
+    Each heartbeat pushes a (deadline, instance_id) entry; a background thread
+    pops entries past their deadline every sweep_interval seconds and marks
+    those instances offline unless a newer heartbeat moved the deadline. Reads
+    (is_online, online_page) never touch the database.
+
+    Subscribers registered with subscribe() are called with
+    (event, instance_id, username) for 'online', 'offline' and 'removed'
+    transitions, outside the tracker's lock.
+
+    The active set is loaded from the database on first use. Heartbeats that
+    other worker processes flushed are picked up by a range query on
+    last_heartbeat during each sweep, and the database is checked again before
+    an instance is declared offline. Offline instances only leave the active
+    set; their rows are deleted (reap_dead_instances) only if a retention is
+    configured.
+    """
+
+    Row = namedtuple('Row', ['username', 'last_heartbeat'])
+
+    def __init__(self, timeout=300, sweep_interval=5, flush_interval=5,
+                 retention=None, reap_interval=3600):
+        self.timeout = timedelta(seconds=timeout)
+        self.sweep_interval = sweep_interval
+        self.flush_interval = flush_interval
+        self.retention = timedelta(seconds=retention) if retention is not None else None
+        self.reap_interval = reap_interval
+        self._heap = []          # (deadline, instance_id); stale entries are skipped
+        self._deadlines = {}     # instance_id -> current deadline, online instances only
+        self._usernames = {}     # instance_id -> username
+        self._online_names = []  # sorted usernames of online instances
+        self._online_ids = {}    # username -> instance_id of online instances
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._pulled_at = None
+        self._reaped_at = time.monotonic()
+        self._thread = None
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def _emit(self, events):
+        for event in events:
+            for callback in list(self._subscribers):
+                try:
+                    callback(*event)
+                except Exception as e:
+                    print(f"Error in liveness subscriber: {e}")
+
+    def _mark(self, instance_id, at, username, events):
+        # Caller holds the lock
+        deadline = at + self.timeout
+        if username:
+            self._usernames[instance_id] = username
+        current = self._deadlines.get(instance_id)
+        if deadline <= datetime.utcnow() or (current is not None and current >= deadline):
+            return
+        heapq.heappush(self._heap, (deadline, instance_id))
+        self._deadlines[instance_id] = deadline
+        if current is None:
+            name = self._usernames.get(instance_id)
+            if name is not None and name not in self._online_ids:
+                bisect.insort(self._online_names, name)
+                self._online_ids[name] = instance_id
+            events.append(('online', instance_id, name))
+
+    def _unmark(self, instance_id):
+        # Caller holds the lock
+        self._deadlines.pop(instance_id, None)
+        name = self._usernames.get(instance_id)
+        if self._online_ids.pop(name, None) is not None:
+            i = bisect.bisect_left(self._online_names, name)
+            if i < len(self._online_names) and self._online_names[i] == name:
+                del self._online_names[i]
+        return name
+
+    def beat(self, instance_id, at=None, username=None):
+        """Extend an instance's deadline; marks it online if it was not"""
+        self._ensure_loaded()
+        at = at or datetime.utcnow()
+        if username is None and instance_id not in self._usernames:
+            username = db.session.query(ExposedInstance.username).filter_by(id=instance_id).scalar()
+        events = []
+        with self._lock:
+            self._mark(instance_id, at, username, events)
+            self._ensure_sweeper()
+        self._emit(events)
+
+    def forget(self, instance_id):
+        with self._lock:
+            self._unmark(instance_id)
+            self._usernames.pop(instance_id, None)
+
+    def is_online(self, instance_id):
+        self._ensure_loaded()
+        with self._lock:
+            deadline = self._deadlines.get(instance_id)
+        return deadline is not None and deadline > datetime.utcnow()
+
+    def online_page(self, after=None, prefix=None, limit=60):
+        """One page of online instances ordered by username, as Row tuples
+
+        Returns:
+            (rows, next_cursor) tuple, next_cursor is None on the last page
+        """
+        self._ensure_loaded()
+        now = datetime.utcnow()
+        start = after or prefix or ''
+        rows = []
+        with self._lock:
+            names = self._online_names
+            i = bisect.bisect_right(names, start) if after else bisect.bisect_left(names, start)
+            while i < len(names) and len(rows) <= limit:
+                name = names[i]
+                if prefix and not name.startswith(prefix):
+                    break
+                deadline = self._deadlines.get(self._online_ids[name])
+                if deadline is not None and deadline > now:
+                    rows.append(self.Row(name, deadline - self.timeout))
+                i += 1
+        next_cursor = rows[limit - 1].username if len(rows) > limit else None
+        return rows[:limit], next_cursor
+
+    def online_count(self):
+        with self._lock:
+            return len(self._deadlines)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with app.app_context():
+            cutoff = datetime.utcnow() - self.timeout
+            rows = db.session.query(
+                ExposedInstance.id, ExposedInstance.username, ExposedInstance.last_heartbeat
+            ).filter(ExposedInstance.last_heartbeat >= cutoff).all()
+        with self._lock:
+            if self._loaded:
+                return
+            for row in rows:
+                self._mark(row.id, row.last_heartbeat, row.username, [])
+            self._pulled_at = datetime.utcnow()
+            self._loaded = True
+            self._ensure_sweeper()
+
+    def sweep(self):
+        """Pull heartbeats flushed by other processes, then expire overdue instances"""
+        now = datetime.utcnow()
+        events = []
+        with app.app_context():
+            with self._lock:
+                since = (self._pulled_at or now) - timedelta(seconds=self.flush_interval + self.sweep_interval)
+            rows = db.session.query(
+                ExposedInstance.id, ExposedInstance.username, ExposedInstance.last_heartbeat
+            ).filter(ExposedInstance.last_heartbeat > since).all()
+            with self._lock:
+                self._pulled_at = now
+                for row in rows:
+                    self._mark(row.id, row.last_heartbeat, row.username, events)
+                expired = []
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, instance_id = heapq.heappop(self._heap)
+                    if self._deadlines.get(instance_id) == deadline:
+                        expired.append(instance_id)
+            if expired:
+                latest = dict(db.session.query(ExposedInstance.id, ExposedInstance.last_heartbeat)
+                              .filter(ExposedInstance.id.in_(expired)).all())
+                with self._lock:
+                    for instance_id in expired:
+                        seen = max(latest.get(instance_id) or datetime.min,
+                                   heartbeats.last_seen(instance_id) or datetime.min)
+                        if self._deadlines.get(instance_id) is None:
+                            continue
+                        if seen + self.timeout > now:
+                            # Beat arrived through another process; re-arm
+                            self._deadlines[instance_id] = seen + self.timeout
+                            heapq.heappush(self._heap, (seen + self.timeout, instance_id))
+                            continue
+                        events.append(('offline', instance_id, self._unmark(instance_id)))
+        self._emit(events)
+
+    def _ensure_sweeper(self):
+        # Caller holds the lock; started lazily like the heartbeat flusher
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='liveness-sweeper', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+                if self.retention is not None and time.monotonic() - self._reaped_at >= self.reap_interval:
+                    self._reaped_at = time.monotonic()
+                    self._emit(reap_dead_instances(self.retention))
+            except Exception as e:
+                print(f"Error in liveness sweep: {e}")
+
+liveness = LivenessTracker(
+    timeout=app.config['HEARTBEAT_TIMEOUT'],
+    sweep_interval=app.config['LIVENESS_SWEEP_INTERVAL'],
+    flush_interval=app.config['HEARTBEAT_FLUSH_INTERVAL'],
+    retention=app.config['INSTANCE_RETENTION'],
+    reap_interval=app.config['REAP_INTERVAL']
+)
+
+def log_liveness(event, instance_id, username):
+    print(f"Instance {username or instance_id} is now {event}")
+
+liveness.subscribe(log_liveness)
+
+# Live update configuration
+app.config['EVENTS_KEEPALIVE'] = 15            # seconds between SSE keepalive comments
+app.config['EVENTS_MAX_STREAMS'] = 1000        # open SSE streams per process; further clients long-poll
+app.config['EVENTS_STREAM_MAX_AGE'] = 300      # seconds before a stream is closed and the browser reconnects
+app.config['EVENTS_POLL_TIMEOUT'] = 25         # seconds a long-poll request waits for an event
+app.config['EVENTS_POLL_INTERVAL'] = 10        # seconds between short polls when EVENTS_POLL_TIMEOUT is 0
+app.config['EVENTS_HISTORY'] = 50              # recent events kept per instance for reconnecting clients
+app.config['EVENTS_QUEUE_SIZE'] = 100          # undelivered events before a slow subscriber is dropped
+
+def limit_event_streams(threads):
+    """Fit live updates to a server that runs every request on its own thread
+
+    An open stream or a waiting long-poll holds one of the process's threads
+    for as long as it lasts, so streams are capped at half of them and polls
+    answer at once (clients then poll every EVENTS_POLL_INTERVAL seconds);
+    the other threads stay free for pages. Called by gunicorn.conf.py for
+    gthread and sync workers; async workers (gevent) need no limit.
+    """
+    app.config['EVENTS_MAX_STREAMS'] = min(app.config['EVENTS_MAX_STREAMS'], threads // 2)
+    app.config['EVENTS_POLL_TIMEOUT'] = 0
+
+class EventBroker:
+    """Fan-out of per-instance page update events to open browser tabs
+
+    Each SSE stream or waiting long-poll request holds a Subscription whose
+    bounded queue receives every event published for its instance; a
+    subscriber that falls EVENTS_QUEUE_SIZE events behind is dropped and
+    reconnects. The last few events of every instance are kept so a client
+    can resume from the id it saw last (Last-Event-ID / ?since=).
+    """
+
+    Event = namedtuple('Event', ['id', 'type', 'data'])
+
+    class Subscription:
+        def __init__(self, queue_size):
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.dropped = False
+
+    def __init__(self, history=50, queue_size=100, watch_grace=60):
+        self.history = history
+        self.queue_size = queue_size
+        self.watch_grace = watch_grace
+        self._ids = itertools.count(1)
+        self._last_id = 0
+        self._events = {}       # instance_id -> deque of recent Events
+        self._subscribers = {}  # instance_id -> set of Subscriptions
+        self._polled_at = {}    # instance_id -> monotonic time of the last long-poll
+        self._streams = 0
+        self._lock = threading.Lock()
+
+    def last_id(self):
+        with self._lock:
+            return self._last_id
+
+    def open_stream(self, limit):
+        """Reserve an SSE stream slot; False when limit streams are open"""
+        with self._lock:
+            if self._streams >= limit:
+                return False
+            self._streams += 1
+            return True
+
+    def close_stream(self):
+        with self._lock:
+            self._streams -= 1
+
+    def subscribe(self, instance_id):
+        subscription = self.Subscription(self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(instance_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, instance_id, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(instance_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[instance_id]
+
+    def note_poll(self, instance_id):
+        with self._lock:
+            self._polled_at[instance_id] = time.monotonic()
+
+    def is_watched(self, instance_id):
+        """True if a tab is connected, or long-polled recently, for this instance"""
+        with self._lock:
+            if self._subscribers.get(instance_id):
+                return True
+            polled_at = self._polled_at.get(instance_id)
+            if polled_at is not None and time.monotonic() - polled_at > self.watch_grace:
+                del self._polled_at[instance_id]
+                polled_at = None
+            return polled_at is not None
+
+    def since(self, instance_id, last_id):
+        with self._lock:
+            return [e for e in self._events.get(instance_id, ()) if e.id > last_id]
+
+    def publish(self, instance_id, event_type, data):
+        with self._lock:
+            event = self.Event(next(self._ids), event_type, data)
+            self._last_id = event.id
+            self._events.setdefault(instance_id, deque(maxlen=self.history)).append(event)
+            subscribers = list(self._subscribers.get(instance_id, ()))
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                subscription.dropped = True
+                self.unsubscribe(instance_id, subscription)
+        return event
+
+    def forget(self, instance_id):
+        with self._lock:
+            self._events.pop(instance_id, None)
+            self._polled_at.pop(instance_id, None)
+
+event_broker = EventBroker(
+    history=app.config['EVENTS_HISTORY'],
+    queue_size=app.config['EVENTS_QUEUE_SIZE']
+)
+
+def publish_status(event, instance_id, username):
+    """Liveness subscriber: push the new status banner to open tabs"""
+    if event == 'removed' or not event_broker.is_watched(instance_id):
+        return
+    with app.app_context():
+        html = render_template('status_banner.html', instance_status=event, data_age=None)
+    event_broker.publish(instance_id, 'status', {'status': event, 'html': html})
+
+liveness.subscribe(publish_status)
+
+def publish_snapshot(instance, endpoint, params, data, content_hash):
+    """Push a changed snapshot to tabs showing its page
+
+    Home and behaviors sections are sent rendered; for files only the folder
+    path is sent, since listings are paged and sorted per viewer.
+    """
+    if not event_broker.is_watched(instance.id):
+        return
+    payload = {'section': endpoint[:-len('_data')], 'content_hash': content_hash}
+    with app.app_context():
+        if endpoint == 'home_data':
+            payload['html'] = render_template('home_content.html', username=instance.username,
+                                              data=data or {"message": "No data available"})
+        elif endpoint == 'behaviors_data':
+            payload['html'] = render_template('behaviors_content.html', username=instance.username,
+                                              tree=behaviors_tree(data))
+        else:
+            payload['path'] = files_path(data, params)
+    event_broker.publish(instance.id, 'section', payload)
 
 def create_tables():
     with app.app_context():
         db.create_all()
+        add_missing_columns()
+        # create_all() skips indexes added to tables that already exist
+        for index in ExposedInstance.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+        migrate_legacy_snapshots()
+
+def add_missing_columns():
+    """Add nullable columns that were added to models after their table was created"""
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                db.session.execute(text(
+                    f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                ))
+    db.session.commit()
+
+def migrate_legacy_snapshots():
+    """Move payloads out of the old home_data/files_data/behaviors_data columns
+
+    Databases created before the snapshot tables still carry those columns on
+    exposed_instance. Their contents are copied into the snapshot tables once
+    and the columns are cleared, so running this again is a no-op.
+    """
+    columns = {c['name'] for c in inspect(db.engine).get_columns('exposed_instance')}
+    legacy = [c for c in SNAPSHOT_ENDPOINTS if c in columns]
+    if not legacy:
+        return
+    rows = db.session.execute(text(
+        f"SELECT id, last_data_sync, {', '.join(legacy)} FROM exposed_instance"
+    )).mappings().all()
+    for row in rows:
+        synced_at = row['last_data_sync']
+        if isinstance(synced_at, str):
+            synced_at = datetime.fromisoformat(synced_at)
+        for kind in legacy:
+            if row[kind] is None:
+                continue
+            data = json.loads(row[kind]) if isinstance(row[kind], str) else row[kind]
+            if data is None:
+                continue
+            if kind == 'files_data':
+                store_directory(row['id'], files_path(data), data, synced_at)
+            else:
+                store_instance_snapshot(row['id'], kind, data, synced_at)
+    db.session.execute(text(
+        f"UPDATE exposed_instance SET {', '.join(f'{c} = NULL' for c in legacy)}"
+    ))
+    db.session.commit()
+
+def snapshot_digest(data):
+    """Return (size, sha256 hex) of the canonical JSON encoding of data"""
+    encoded = json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+    return len(encoded), hashlib.sha256(encoded).hexdigest()
+
+def store_instance_snapshot(instance_id, kind, data, synced_at=None, validators=None):
+    """Upsert the home_data / behaviors_data snapshot; the caller commits"""
+    synced_at = synced_at or datetime.utcnow()
+    validators = validators or {}
+    size, content_hash = snapshot_digest(data)
+    row = InstanceSnapshot.query.filter_by(instance_id=instance_id, kind=kind).first()
+    if row is None:
+        row = InstanceSnapshot(instance_id=instance_id, kind=kind)
+        db.session.add(row)
+    row.data = data
+    row.size = size
+    row.content_hash = content_hash
+    row.updated_at = synced_at
+    row.upstream_etag = validators.get('etag')
+    row.upstream_last_modified = validators.get('last_modified')
+    return content_hash
+
+def store_directory(instance_id, path, data, synced_at=None, validators=None):
+    """Upsert the listing for path and evict least recently used folders
+
+    Keeps at most DIRECTORY_CACHE_MAX_ENTRIES folders per instance. The caller
+    commits.
+    """
+    synced_at = synced_at or datetime.utcnow()
+    validators = validators or {}
+    size, content_hash = snapshot_digest(data)
+    row = DirectorySnapshot.query.filter_by(instance_id=instance_id, path=path).first()
+    if row:
+        row.data = data
+        row.size = size
+        row.content_hash = content_hash
+        row.fetched_at = synced_at
+        row.last_access = synced_at
+        row.upstream_etag = validators.get('etag')
+        row.upstream_last_modified = validators.get('last_modified')
+    else:
+        db.session.add(DirectorySnapshot(
+            instance_id=instance_id, path=path, data=data,
+            size=size, content_hash=content_hash,
+            fetched_at=synced_at, last_access=synced_at,
+            upstream_etag=validators.get('etag'),
+            upstream_last_modified=validators.get('last_modified')
+        ))
+        db.session.flush()
+        excess = DirectorySnapshot.query.filter_by(instance_id=instance_id).count() \
+            - app.config['DIRECTORY_CACHE_MAX_ENTRIES']
+        if excess > 0:
+            oldest = DirectorySnapshot.query.with_entities(DirectorySnapshot.id, DirectorySnapshot.path) \
+                .filter_by(instance_id=instance_id) \
+                .order_by(DirectorySnapshot.last_access.asc()) \
+                .limit(excess) \
+                .all()
+            DirectorySnapshot.query.filter(DirectorySnapshot.id.in_([row.id for row in oldest])) \
+                .delete(synchronize_session=False)
+            for row in oldest:
+                file_search.remove_directory(instance_id, row.path)
+                relay_snapshot(instance_id, 'files_data', row.path)
+    file_search.update_directory(instance_id, path, data)
+    return content_hash
+
+def ensure_search_index(instance_id):
+    """Build the instance's file search index from stored listings if needed
+
+    Folders other processes store later reach the index through the
+    invalidation log (adopt_relayed_snapshot).
+    """
+    invalidations.ensure_listening()
+    if file_search.is_loaded(instance_id):
+        return
+    rows = DirectorySnapshot.query.with_entities(DirectorySnapshot.path, DirectorySnapshot.data) \
+        .filter_by(instance_id=instance_id) \
+        .all()
+    file_search.load(instance_id, [(row.path, row.data) for row in rows])
+
+def load_directory(instance_id, path, touch=True):
+    """Return the stored DirectorySnapshot for path (marking it used), or None"""
+    row = DirectorySnapshot.query.filter_by(instance_id=instance_id, path=path).first()
+    if row and touch:
+        # The LRU timestamp is written in the background; readers don't wait for it
+        db_writer.submit(touch_directory, instance_id, path, datetime.utcnow())
+    return row
+
+def touch_directory(instance_id, path, at):
+    DirectorySnapshot.query.filter_by(instance_id=instance_id, path=path) \
+        .update({'last_access': at}, synchronize_session=False)
+
+def note_directory_access(instance_id, params=None):
+    """Mark a folder served from memory as used, at most once per SNAPSHOT_TOUCH_INTERVAL"""
+    path = files_path(None, params)
+    if snapshot_cache.should_touch((instance_id, 'access', path), app.config['SNAPSHOT_TOUCH_INTERVAL']):
+        db_writer.submit(touch_directory, instance_id, path, datetime.utcnow())
+
+def files_path(data, params=None):
+    """Folder a files_data document belongs to"""
+    if params and 'path' in params:
+        return params['path']
+    return data.get('path', '') if isinstance(data, dict) else ''
+
+def store_snapshot(instance, endpoint, data, params=None, synced_at=None, validators=None):
+    """Persist a snapshot on an ExposedInstance row and return its content hash
+
+    The caller commits.
+    """
+    synced_at = synced_at or datetime.utcnow()
+    if endpoint == 'files_data':
+        if params and not is_first_listing_page(params):
+            # Later pages and other sort orders are only kept in memory
+            return snapshot_digest(data)[1]
+        path = files_path(data, params)
+        content_hash = store_directory(instance.id, path, data, synced_at, validators)
+    else:
+        path = None
+        content_hash = store_instance_snapshot(instance.id, endpoint, data, synced_at, validators)
+    instance.last_data_sync = synced_at
+    relay_snapshot(instance.id, endpoint, path)
+    return content_hash
+
+def relay_snapshot(instance_id, endpoint, path=None):
+    """Tell the other worker processes a stored snapshot changed; the caller commits"""
+    if multiple_processes():
+        invalidations.broadcast(instance_id, 'snapshot', {'endpoint': endpoint, 'path': path})
+
+def adopt_relayed_snapshot(instance_id, endpoint, path=None):
+    """Apply a snapshot another process stored to the search index and watching tabs
 
-def render_page(username, title, content, instance_status=None):
-    return render_template_string(
-        BASE_TEMPLATE, 
+    Nothing is loaded for instances that nobody here watches or searches;
+    their cached copies are checked against the DB when next served.
+    """
+    indexed = endpoint == 'files_data' and file_search.is_loaded(instance_id)
+    if not (indexed or event_broker.is_watched(instance_id)):
+        return
+    instance = db.session.get(ExposedInstance, instance_id)
+    if instance is None:
+        return
+    params = {'path': path} if endpoint == 'files_data' else None
+    stored = load_stored_snapshot(instance, endpoint, params, touch=False)
+    if indexed:
+        if stored is None:
+            file_search.remove_directory(instance_id, path)
+        else:
+            file_search.update_directory(instance_id, path, stored.data)
+    if stored is None:
+        return
+    key = snapshot_key(instance_id, endpoint, params)
+    cached = snapshot_cache.get(key)
+    if cached is not None and cached.content_hash == stored.content_hash:
+        return
+    snapshot_cache.put(key, stored.data, stored.synced_at, stored.content_hash, stored.validators)
+    publish_snapshot(instance, endpoint, params, stored.data, stored.content_hash)
+
+def touch_snapshot(instance, endpoint, params=None, synced_at=None, validators=None):
+    """Mark a stored snapshot as confirmed current without rewriting its JSON"""
+    synced_at = synced_at or datetime.utcnow()
+    if endpoint == 'files_data' and params and not is_first_listing_page(params):
+        return
+    changes = {}
+    if validators:
+        changes = {'upstream_etag': validators.get('etag'),
+                   'upstream_last_modified': validators.get('last_modified')}
+    if endpoint == 'files_data':
+        DirectorySnapshot.query.filter_by(instance_id=instance.id, path=files_path(None, params)) \
+            .update({'fetched_at': synced_at, 'last_access': synced_at, **changes},
+                    synchronize_session=False)
+    else:
+        InstanceSnapshot.query.filter_by(instance_id=instance.id, kind=endpoint) \
+            .update({'updated_at': synced_at, **changes}, synchronize_session=False)
+    instance.last_data_sync = synced_at
+
+def snapshot_hashes(instance_id):
+    """Content hashes of everything stored for an instance, for delta sync"""
+    hashes = {'home_data': None, 'behaviors_data': None, 'files_data': {}}
+    for kind, content_hash in db.session.query(
+            InstanceSnapshot.kind, InstanceSnapshot.content_hash).filter_by(instance_id=instance_id):
+        hashes[kind] = content_hash
+    for path, content_hash in db.session.query(
+            DirectorySnapshot.path, DirectorySnapshot.content_hash).filter_by(instance_id=instance_id):
+        hashes['files_data'][path] = content_hash
+    return hashes
+
+# Delta sync: instead of full documents, /register and /heartbeat payloads may
+# carry a 'sync' list of items {'kind', 'path' (files_data only), 'base', and
+# either 'unchanged': true or 'patch': [JSON Patch ops] plus an optional
+# 'hash' of the patched result}. 'base' is the snapshot_digest hash of the
+# server's copy, as returned by GET /sync/<token>.
+class PatchError(ValueError):
+    """Raised when a JSON Patch operation cannot be applied"""
+
+class SyncConflict(Exception):
+    """Raised when delta sync items do not match the stored snapshots"""
+
+    def __init__(self, conflicts):
+        super().__init__(f"{len(conflicts)} sync item(s) rejected")
+        self.conflicts = conflicts
+
+class InvalidPayload(ValueError):
+    """Raised when a pushed payload does not have the expected shape"""
+
+def check_payload(payload):
+    """Raise InvalidPayload unless payload is shaped like a /register or /heartbeat payload"""
+    if not isinstance(payload, dict):
+        raise InvalidPayload("Payload must be a JSON object")
+    sync = payload.get('sync')
+    if sync is not None and not (isinstance(sync, list) and all(isinstance(item, dict) for item in sync)):
+        raise InvalidPayload("'sync' must be a list of objects")
+    if payload.get('files_data') is not None and not isinstance(payload['files_data'], dict):
+        raise InvalidPayload("'files_data' must be an object")
+    allowed_users = payload.get('allowed_users')
+    if allowed_users is not None and not isinstance(allowed_users, list):
+        raise InvalidPayload("'allowed_users' must be a list")
+
+def _pointer_parts(pointer):
+    if pointer == '':
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith('/'):
+        raise PatchError(f"Invalid JSON pointer: {pointer!r}")
+    return [part.replace('~1', '/').replace('~0', '~') for part in pointer[1:].split('/')]
+
+def _list_index(items, part, allow_end=False):
+    if allow_end and part == '-':
+        return len(items)
+    if not part.isdigit():
+        raise PatchError(f"Invalid list index: {part!r}")
+    index = int(part)
+    if index > len(items) or (index == len(items) and not allow_end):
+        raise PatchError(f"List index out of range: {index}")
+    return index
+
+def _walk(doc, parts):
+    for part in parts:
+        if isinstance(doc, list):
+            doc = doc[_list_index(doc, part)]
+        elif isinstance(doc, dict):
+            if part not in doc:
+                raise PatchError(f"Path not found: {part!r}")
+            doc = doc[part]
+        else:
+            raise PatchError(f"Cannot descend into {type(doc).__name__}")
+    return doc
+
+def _add(doc, parts, value):
+    if not parts:
+        return value
+    parent = _walk(doc, parts[:-1])
+    if isinstance(parent, list):
+        parent.insert(_list_index(parent, parts[-1], allow_end=True), value)
+    elif isinstance(parent, dict):
+        parent[parts[-1]] = value
+    else:
+        raise PatchError(f"Cannot add to {type(parent).__name__}")
+    return doc
+
+def _remove(doc, parts):
+    if not parts:
+        raise PatchError("Cannot remove the document root")
+    parent = _walk(doc, parts[:-1])
+    if isinstance(parent, list):
+        return parent.pop(_list_index(parent, parts[-1]))
+    if isinstance(parent, dict) and parts[-1] in parent:
+        return parent.pop(parts[-1])
+    raise PatchError(f"Path not found: {parts[-1]!r}")
+
+def apply_json_patch(doc, operations):
+    """Apply RFC 6902 operations to a copy of doc and return the result"""
+    doc = copy.deepcopy(doc)
+    for operation in operations:
+        try:
+            op, parts = operation['op'], _pointer_parts(operation['path'])
+            if op == 'add':
+                doc = _add(doc, parts, copy.deepcopy(operation['value']))
+            elif op == 'remove':
+                _remove(doc, parts)
+            elif op == 'replace':
+                if parts:
+                    _walk(doc, parts)  # must exist
+                    parent = _walk(doc, parts[:-1])
+                    if isinstance(parent, list):
+                        parent[_list_index(parent, parts[-1])] = copy.deepcopy(operation['value'])
+                    else:
+                        parent[parts[-1]] = copy.deepcopy(operation['value'])
+                else:
+                    doc = copy.deepcopy(operation['value'])
+            elif op == 'move':
+                value = _remove(doc, _pointer_parts(operation['from']))
+                doc = _add(doc, parts, value)
+            elif op == 'copy':
+                value = copy.deepcopy(_walk(doc, _pointer_parts(operation['from'])))
+                doc = _add(doc, parts, value)
+            elif op == 'test':
+                if _walk(doc, parts) != operation['value']:
+                    raise PatchError(f"Test failed at {operation['path']!r}")
+            else:
+                raise PatchError(f"Unknown operation: {op!r}")
+        except (KeyError, TypeError) as e:
+            raise PatchError(f"Malformed operation {operation!r}: {e}")
+    return doc
+
+def current_snapshot(instance, endpoint, params=None):
+    """Return (data, content_hash) stored in the DB for a page
+
+    The DB row is what /sync reports and what other processes write, so it
+    decides; the cached copy only saves loading the JSON when it matches.
+    """
+    if endpoint == 'files_data':
+        model = DirectorySnapshot
+        query = model.query.filter_by(instance_id=instance.id, path=files_path(None, params))
+    else:
+        model = InstanceSnapshot
+        query = model.query.filter_by(instance_id=instance.id, kind=endpoint)
+    content_hash = query.with_entities(model.content_hash).scalar()
+    if content_hash is None:
+        return None, None
+    entry = snapshot_cache.get(snapshot_key(instance.id, endpoint, params))
+    if entry and entry.content_hash == content_hash:
+        return entry.data, content_hash
+    row = query.first()
+    return (row.data, row.content_hash) if row else (None, None)
+
+def apply_pushed_payload(instance, payload, synced_at):
+    """Store full snapshots and delta sync items from a /register or /heartbeat payload
+
+    Every sync item is checked against the stored snapshot before anything is
+    written; on any mismatch SyncConflict is raised and nothing changes. A
+    malformed payload raises InvalidPayload. The caller commits and then
+    passes the result to cache_stored_snapshots().
+
+    Returns:
+        list of (endpoint, params, data, content_hash) that are now current
+    """
+    check_payload(payload)
+    updates = []
+    for endpoint in SNAPSHOT_ENDPOINTS:
+        if payload.get(endpoint) is not None:
+            params = {'path': files_path(payload[endpoint])} if endpoint == 'files_data' else None
+            updates.append((endpoint, params, payload[endpoint]))
+
+    confirmed, conflicts = [], []
+    for item in payload.get('sync') or []:
+        endpoint = item.get('kind')
+        params = {'path': str(item.get('path', '')).strip('/')} if endpoint == 'files_data' else None
+        problem = {'kind': endpoint, 'path': params['path'] if params else None}
+        if endpoint not in SNAPSHOT_ENDPOINTS:
+            conflicts.append({**problem, 'error': 'Unknown snapshot kind'})
+            continue
+        current, current_hash = current_snapshot(instance, endpoint, params)
+        if item.get('base') != current_hash:
+            conflicts.append({**problem, 'error': 'Version mismatch', 'current': current_hash})
+            continue
+        if item.get('unchanged'):
+            if current is not None:
+                confirmed.append((endpoint, params, current, current_hash))
+            continue
+        try:
+            patched = apply_json_patch(current, item.get('patch') or [])
+        except PatchError as e:
+            conflicts.append({**problem, 'error': str(e), 'current': current_hash})
+            continue
+        if item.get('hash') and snapshot_digest(patched)[1] != item['hash']:
+            conflicts.append({**problem, 'error': 'Patched document hash mismatch', 'current': current_hash})
+            continue
+        updates.append((endpoint, params, patched))
+    if conflicts:
+        raise SyncConflict(conflicts)
+
+    stored = []
+    for endpoint, params, data in updates:
+        stored.append((endpoint, params, data, store_snapshot(instance, endpoint, data, params, synced_at)))
+    for endpoint, params, data, content_hash in confirmed:
+        touch_snapshot(instance, endpoint, params, synced_at)
+        stored.append((endpoint, params, data, content_hash))
+    return stored
+
+def load_stored_snapshot(instance, endpoint, params=None, touch=True):
+    """Return the StoredSnapshot persisted for this page, or None"""
+    if endpoint == 'files_data' and params and not is_first_listing_page(params):
+        return None
+    if endpoint == 'files_data':
+        row = load_directory(instance.id, files_path(None, params), touch)
+        synced_at = row.fetched_at if row else None
+    else:
+        row = InstanceSnapshot.query.filter_by(instance_id=instance.id, kind=endpoint).first()
+        synced_at = row.updated_at if row else None
+    if row is None:
+        return None
+    validators = {'etag': row.upstream_etag, 'last_modified': row.upstream_last_modified}
+    return StoredSnapshot(row.data, synced_at, row.content_hash, validators)
+
+def render_page(template, username, title, instance_status=None, synced_at=None, stream=False,
+                **context):
+    """Render a page template; stream=True yields it in chunks instead of one string"""
+    data_age = None
+    if synced_at:
+        data_age = max(0, int((datetime.utcnow() - synced_at).total_seconds()))
+    context.setdefault('access_args', access_args())
+    context.setdefault('live_section', None)
+    context.setdefault('last_event_id', event_broker.last_id())
+    if stream:
+        return app.response_class(stream_template(
+            template,
+            username=username,
+            title=title,
+            instance_status=instance_status,
+            data_age=data_age,
+            **context
+        ), mimetype='text/html')
+    return render_template(
+        template, 
         username=username,
         title=title,
-        content=content,
-        instance_status=instance_status
+        instance_status=instance_status,
+        data_age=data_age,
+        **context
     )
 
+def conditional_page(page, render, *variant):
+    """Answer with 304 if the client already has this page, else render it
+
+    The weak ETag covers the snapshot's content hash, its sync time, the
+    status banner and any extra variant values (path, template...), so a
+    page is only re-rendered when something visible on it changed.
+    """
+    data_age = None
+    if page.status == 'stale' and page.synced_at:
+        data_age = int((datetime.utcnow() - page.synced_at).total_seconds())
+    etag = hashlib.sha1(repr(
+        (page.content_hash, page.synced_at, page.status, data_age) + variant
+    ).encode()).hexdigest()
+    if not is_resource_modified(request.environ, etag=etag, last_modified=page.synced_at):
+        response = app.response_class(status=304)
+    else:
+        response = app.make_response(render())
+    response.set_etag(etag, weak=True)
+    if page.synced_at:
+        response.last_modified = page.synced_at
+    response.cache_control.no_cache = True
+    return response
+
+def access_required_page():
+    # Keep the page's other query args (e.g. path) when the email form is submitted
+    hidden_args = {k: v for k, v in request.args.items() if k != 'email'}
+    return render_template('access_required.html', hidden_args=hidden_args)
+
 def fetch_local_data(instance, endpoint, params=None):
     """Fetch data from local instance with timeout
     
@@ -214,43 +2703,499 @@ def fetch_local_data(instance, endpoint, params=None):
         params: Optional query parameters
         
     Returns:
-        (data, is_fresh) tuple, where data is the API response and is_fresh indicates
-        whether the data was successfully retrieved from the instance
+        (data, is_fresh) tuple, where data is the API response and is_fresh indicates
+        whether the data was successfully retrieved from the instance
+    """
+    result = fetch_local_snapshot(instance, endpoint, params)
+    return result.data, result.is_fresh
+
+def fetch_local_snapshot(instance, endpoint, params=None, validators=None):
+    """Conditionally fetch a snapshot from the local instance
+
+    validators ({'etag', 'last_modified'}) from the cached copy are sent as
+    If-None-Match / If-Modified-Since, so an unchanged snapshot costs a 304
+    instead of a full download.
+
+    Returns:
+        UpstreamResult(data, is_fresh, not_modified, validators)
+    """
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    try:
+        response = upstream_request(
+            instance,
+            f"/api/{endpoint}",
+            params=params,
+            headers=headers,
+            timeout=5
+        )
+        received = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')
+        }
+        if response.status_code == 304 and headers:
+            return UpstreamResult(None, True, True, received if any(received.values()) else validators)
+        if response.ok:
+            return UpstreamResult(response.json(), True, False, received)
+    except CircuitOpenError:
+        pass
+    except Exception as e:
+        print(f"Error fetching data from {endpoint}: {e}")
+    return UpstreamResult(None, False, False, None)
+    
+def check_access(instance, request):
+    """Check if current user has access to the instance"""
+    # Get email from query params
+    return user_has_access(instance, request.args.get('email'))
+
+def user_has_access(instance, user_email):
+    """Check user_email against the instance's allowed_users list
+
+    Served from acl_cache while the cached list is fresh; otherwise the list is
+    fetched from the local instance (once for all concurrent callers) and
+    cached as a set.
+    """
+    cached = acl_cache.lookup(instance.id, user_email)
+    if cached is not None:
+        return cached
+    ref = instance if isinstance(instance, InstanceRef) else instance.ref()
+    allowed_users = upstream_flights.submit(('acl', ref.id), fetch_allowed_users, ref).result()
+    return access_from_list(ref.id, allowed_users, user_email)
+
+def fetch_allowed_users(instance):
+    """Load the allowed_users list into acl_cache; returns the set or None
+
+    A list another worker process fetched within ACL_TTL is taken from the
+    shared cache; otherwise it is downloaded from the local instance and
+    shared.
+    """
+    with app.app_context():
+        shared = load_shared_acl(instance.id)
+    if shared is not None:
+        return shared
+    
+    # Try to fetch allowed_users from local instance
+    try:
+        response = upstream_request(instance, "/api/allowed_users", timeout=3)
+        if response.ok:
+            body = response.json()
+            allowed_users = body.get('allowed_users', [])
+            acl_cache.put(instance.id, allowed_users, body.get('version'))
+            db_writer.submit(store_shared_acl, instance.id, allowed_users, body.get('version'))
+            return frozenset(allowed_users)
+    except CircuitOpenError:
+        pass
+    except Exception as e:
+        print(f"Error checking access: {e}")
+    return None
+
+def load_shared_acl(instance_id):
+    """Cache and return the shared allowed_users set if it is still fresh, else None"""
+    invalidations.ensure_listening()
+    row = shared_get(f"acl:{instance_id}")
+    if row is None or not row.value:
+        return None
+    age = (datetime.utcnow() - row.updated_at).total_seconds()
+    if age > acl_cache.ttl:
+        return None
+    acl_cache.put(instance_id, row.value['users'], row.value.get('version'), age=max(0, age))
+    return frozenset(row.value['users'])
+
+def store_shared_acl(instance_id, users, version=None):
+    """Share a fetched or pushed list with the other processes; the caller commits"""
+    shared_put(f"acl:{instance_id}", {'users': list(users), 'version': version},
+               ttl=app.config['ACL_TTL'])
+
+def share_acl_push(instance_id, payload):
+    """Apply allowed_users / acl_version from a heartbeat here and in other processes
+
+    Only a list or version that differs from the shared one is broadcast, so
+    instances repeating the same acl_version cause no writes. The caller
+    commits.
+    """
+    acl_cache.apply_push(instance_id, payload)
+    if 'allowed_users' not in payload and payload.get('acl_version') is None:
+        return
+    row = shared_get(f"acl:{instance_id}")
+    current = row.value if row is not None and row.value else None
+    if 'allowed_users' in payload:
+        users = sorted(payload['allowed_users'] or [])
+        if current is None or sorted(current['users']) != users \
+                or current.get('version') != payload.get('acl_version'):
+            store_shared_acl(instance_id, users, payload.get('acl_version'))
+            invalidations.broadcast(instance_id, 'acl')
+    elif current is not None and current.get('version') != payload['acl_version']:
+        shared_delete(f"acl:{instance_id}")
+        invalidations.broadcast(instance_id, 'acl')
+
+def access_from_list(instance_id, allowed_users, user_email):
+    """Decide access from a fetched list, or from fallbacks when the fetch failed"""
+    if allowed_users is not None:
+        return acl_allows(allowed_users, user_email)
+
+    # An expired list is still a better answer than none
+    entry = acl_cache.get(instance_id)
+    if entry is not None:
+        return acl_allows(entry.users, user_email)
+
+    # If we can't get the allowed users list, default to allowing access
+    # You might want to change this based on your security requirements
+    return True
+
+def refresh_snapshot(instance, endpoint, params=None):
+    """Bring a cached snapshot up to date, at most once across worker processes
+
+    With several worker processes, a copy that another process stored since
+    this one cached its own is adopted from the DB. Otherwise a lease makes
+    sure only one process contacts the instance; the others keep serving
+    their cached copy, as not fresh, until the refreshed one reaches the DB.
+    Snapshots not cached here at all are fetched without a lease, so first
+    views never wait on another process. A single process needs neither:
+    upstream_flights already joins its concurrent refreshes.
+
+    Returns:
+        (data, is_fresh) like fetch_local_data
+    """
+    key = snapshot_key(instance.id, endpoint, params)
+    cached = snapshot_cache.get(key)
+    if cached is None or not multiple_processes():
+        return fetch_and_store_snapshot(instance, endpoint, params)
+    
+    with app.app_context():
+        adopted = adopt_stored_snapshot(instance, endpoint, params, cached)
+        if adopted is not None:
+            return adopted.data, True
+        lease = f"refresh:{key!r}"
+        if not acquire_lease(lease, app.config['UPSTREAM_PAGE_DEADLINE'] * 2):
+            return cached.data, False
+    try:
+        return fetch_and_store_snapshot(instance, endpoint, params)
+    finally:
+        with app.app_context():
+            release_lease(lease)
+
+def stored_synced_at(instance_id, endpoint, params=None):
+    """Sync time of the stored copy of a snapshot, without loading its JSON"""
+    if endpoint == 'files_data':
+        return db.session.query(DirectorySnapshot.fetched_at) \
+            .filter_by(instance_id=instance_id, path=files_path(None, params)).scalar()
+    return db.session.query(InstanceSnapshot.updated_at) \
+        .filter_by(instance_id=instance_id, kind=endpoint).scalar()
+
+def adopt_stored_snapshot(instance, endpoint, params, cached):
+    """Cache the stored copy if another process synced it after cached and within the TTL"""
+    if endpoint == 'files_data' and params and not is_first_listing_page(params):
+        return None
+    synced_at = stored_synced_at(instance.id, endpoint, params)
+    if synced_at is None or synced_at <= cached.synced_at \
+            or (datetime.utcnow() - synced_at).total_seconds() > snapshot_cache.ttl(endpoint):
+        return None
+    stored = load_stored_snapshot(instance, endpoint, params)
+    if stored is None:
+        return None
+    snapshot_cache.put(snapshot_key(instance.id, endpoint, params), stored.data,
+                       stored.synced_at, stored.content_hash, stored.validators)
+    if stored.content_hash != cached.content_hash:
+        publish_snapshot(instance, endpoint, params, stored.data, stored.content_hash)
+    return stored
+
+def fetch_and_store_snapshot(instance, endpoint, params=None):
+    """Fetch a snapshot from the local instance and store it in the cache and DB
+
+    Uses the cached copy's validators for a conditional fetch. When the
+    instance answers 304, or the body hashes to what is already cached, only
+    the sync time is refreshed (and written to the DB at most once per
+    SNAPSHOT_TOUCH_INTERVAL) instead of rewriting the JSON.
+
+    Runs on upstream worker threads; the write is handed to db_writer, which
+    re-loads the instance row by id.
+    """
+    key = snapshot_key(instance.id, endpoint, params)
+    cached = snapshot_cache.get(key)
+    result = fetch_local_snapshot(instance, endpoint, params, cached.validators if cached else None)
+    if result.not_modified and cached is None:
+        # Evicted while the request was in flight; fetch the body unconditionally
+        result = fetch_local_snapshot(instance, endpoint, params)
+    if not (result.data or result.not_modified):
+        return result.data, result.is_fresh
+    if endpoint == 'files_data' and params and not is_first_listing_page(params) \
+            and isinstance(result.data, dict) and 'total' not in result.data:
+        # The instance ignored paging and sent the whole folder: keep it once,
+        # as the folder's first page, and cut later windows from that copy
+        params = {**params, **listing_defaults()}
+        key = snapshot_key(instance.id, endpoint, params)
+        cached = snapshot_cache.get(key)
+
+    synced_at = datetime.utcnow()
+    if result.not_modified:
+        data, content_hash, changed = cached.data, cached.content_hash, False
+    else:
+        data, content_hash = result.data, snapshot_digest(result.data)[1]
+        changed = cached is None or cached.content_hash != content_hash
+    snapshot_cache.put(key, data, synced_at, content_hash, result.validators)
+
+    if not changed and not snapshot_cache.should_touch(key, app.config['SNAPSHOT_TOUCH_INTERVAL']):
+        return data, True
+    def write():
+        row = db.session.get(ExposedInstance, instance.id)
+        if row:
+            if changed:
+                store_snapshot(row, endpoint, data, params, synced_at, result.validators)
+            else:
+                touch_snapshot(row, endpoint, params, synced_at, result.validators)
+    try:
+        db_writer.run(write)
+    except Exception as e:
+        print(f"Error storing {endpoint} for {instance.username}: {e}")
+    if changed and cached is not None:
+        publish_snapshot(instance, endpoint, params, data, content_hash)
+    return data, True
+
+def submit_refresh(instance, endpoint, params=None):
+    """Start refresh_snapshot, or join the one already running for this page"""
+    key = ('snapshot',) + snapshot_key(instance.id, endpoint, params)
+    return upstream_flights.submit(key, refresh_snapshot, instance, endpoint, params)
+
+# Folder prefetch configuration
+app.config['PREFETCH_CHILDREN'] = 3            # subfolders warmed after a folder is viewed
+app.config['PREFETCH_MAX_CONCURRENT'] = 2      # prefetches in flight per instance
+app.config['PREFETCH_BUDGET'] = 30             # prefetches per instance per budget window
+app.config['PREFETCH_BUDGET_WINDOW'] = 60      # seconds
+app.config['PREFETCH_MAX_TRACKED'] = 5000      # folders with view counts kept per instance
+app.config['PREFETCH_WORKERS'] = 4             # threads for prefetches, also the cap on prefetches in flight
+
+class FolderPrefetcher:
+    """Warms the snapshot cache for the subfolders a viewer is likely to open next
+
+    Every folder view is counted. After a folder is served, its visible
+    subfolders are ranked by how often they have been viewed (listing order
+    breaks ties) and the first few that are not cached fresh are refreshed
+    in the background through the same single-flight key a click would use,
+    so a click that arrives mid-prefetch waits on it instead of fetching
+    again. Each instance gets at most max_concurrent prefetches in flight and
+    budget per window; nothing is prefetched while its circuit is not closed.
+
+    Prefetches run on their own small executor, never on upstream_executor,
+    so page handlers are not queued behind them; at most max_total are in
+    flight across all instances, and the rest are skipped rather than queued.
+    """
+
+    def __init__(self, children=3, max_concurrent=2, budget=30, window=60, max_tracked=5000,
+                 max_total=4):
+        self.children = children
+        self.max_concurrent = max_concurrent
+        self.max_total = max_total
+        self.budget = budget
+        self.window = window
+        self.max_tracked = max_tracked
+        self.started = 0
+        self._views = {}   # instance_id -> Counter of folder path -> views
+        self._active = {}  # instance_id -> prefetches in flight
+        self._in_flight = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_total, thread_name_prefix='prefetch')
+        self._spent = {}   # instance_id -> [window start, prefetches started in it]
+        self._lock = threading.Lock()
+
+    def note_view(self, instance_id, path):
+        with self._lock:
+            views = self._views.setdefault(instance_id, Counter())
+            views[path] += 1
+            if len(views) > self.max_tracked:
+                # Keep the most viewed half, with halved counts so newer habits can catch up
+                kept = views.most_common(self.max_tracked // 2)
+                self._views[instance_id] = Counter({p: (n + 1) // 2 for p, n in kept})
+
+    def rank(self, instance_id, paths):
+        """paths ordered by view count, most viewed first"""
+        with self._lock:
+            views = self._views.get(instance_id) or {}
+            return sorted(paths, key=lambda p: -views.get(p, 0))
+
+    def _take_slot(self, instance_id):
+        now = time.monotonic()
+        with self._lock:
+            if self._in_flight >= self.max_total or self._active.get(instance_id, 0) >= self.max_concurrent:
+                return False
+            spent = self._spent.get(instance_id)
+            if spent is None or now - spent[0] >= self.window:
+                spent = self._spent[instance_id] = [now, 0]
+            if spent[1] >= self.budget:
+                return False
+            spent[1] += 1
+            self._active[instance_id] = self._active.get(instance_id, 0) + 1
+            self._in_flight += 1
+            self.started += 1
+            return True
+
+    def _release_slot(self, instance_id):
+        with self._lock:
+            self._in_flight -= 1
+            active = self._active.get(instance_id, 0) - 1
+            if active > 0:
+                self._active[instance_id] = active
+            else:
+                self._active.pop(instance_id, None)
+
+    def after_listing(self, instance, path, rows):
+        """Prefetch the likeliest subfolders among rows (kind, item) of a served folder"""
+        if not breakers.get(instance.id).is_closed():
+            return
+        prefix = path + '/' if path else ''
+        children = [prefix + item['name'] for kind, item in rows if kind == 'folder' and item.get('name')]
+        ttl = snapshot_cache.ttl('files_data')
+        submitted = 0
+        for child in self.rank(instance.id, children):
+            if submitted >= self.children:
+                break
+            params = {**listing_defaults(), 'path': child}
+            key = snapshot_key(instance.id, 'files_data', params)
+            cached = snapshot_cache.get(key)
+            if cached is not None and time.monotonic() - cached.fetched_at <= ttl:
+                continue
+            if not self._take_slot(instance.id):
+                break
+            future = upstream_flights.submit(('snapshot',) + key, prefetch_folder, instance, params,
+                                             executor=self._executor)
+            future.add_done_callback(lambda done, instance_id=instance.id: self._release_slot(instance_id))
+            submitted += 1
+
+    def forget(self, instance_id):
+        with self._lock:
+            self._views.pop(instance_id, None)
+            self._spent.pop(instance_id, None)
+
+def prefetch_folder(instance, params):
+    """Cache a folder listing, from the DB if a fresh copy is stored there
+
+    Returns (data, is_fresh) like refresh_snapshot, whose flight it shares.
+    """
+    key = snapshot_key(instance.id, 'files_data', params)
+    if snapshot_cache.get(key) is None:
+        with app.app_context():
+            stored = load_stored_snapshot(instance, 'files_data', params)
+        if stored is not None:
+            snapshot_cache.put(key, stored.data, stored.synced_at, stored.content_hash, stored.validators)
+            age = (datetime.utcnow() - stored.synced_at).total_seconds()
+            if age <= snapshot_cache.ttl('files_data'):
+                return stored.data, True
+    return refresh_snapshot(instance, 'files_data', params)
+
+folder_prefetcher = FolderPrefetcher(
+    children=app.config['PREFETCH_CHILDREN'],
+    max_concurrent=app.config['PREFETCH_MAX_CONCURRENT'],
+    budget=app.config['PREFETCH_BUDGET'],
+    window=app.config['PREFETCH_BUDGET_WINDOW'],
+    max_tracked=app.config['PREFETCH_MAX_TRACKED'],
+    max_total=app.config['PREFETCH_WORKERS']
+)
+
+def cache_stored_snapshots(instance, stored, synced_at):
+    """Seed the snapshot cache with the result of apply_pushed_payload()
+
+    Snapshots that differ from the cached copy are pushed to open tabs.
+    """
+    for endpoint, params, data, content_hash in stored:
+        key = snapshot_key(instance.id, endpoint, params)
+        cached = snapshot_cache.get(key)
+        snapshot_cache.put(key, data, synced_at, content_hash)
+        if cached is None or cached.content_hash != content_hash:
+            publish_snapshot(instance, endpoint, params, data, content_hash)
+
+def fetch_page_data(instance, endpoint, params=None, user_email=None, check_acl=True):
+    """Load a page's snapshot and run its access check concurrently
+
+    Snapshots younger than their TTL come straight from snapshot_cache, which
+    is seeded from the DB on a miss. Stale ones are served immediately while a
+    background refresh runs. Otherwise the data fetch and the allowed_users
+    check are issued together and share one deadline (UPSTREAM_PAGE_DEADLINE),
+    so a slow instance costs a worker at most that long instead of the sum of
+    the two timeouts. Both go through upstream_flights, so concurrent viewers
+    of the same page wait on the same upstream requests. A call still running
+    at the deadline is abandoned: access falls back to allowed, as when the
+    instance is unreachable, and data to None so the caller serves its cached
+    copy.
+
+    Returns:
+        PageData(allowed, data, status, synced_at, content_hash)
     """
-    try:
-        url = f"{instance.local_url}/api/{endpoint}"
-        response = requests.get(
-            url,
-            params=params,
-            timeout=5
-        )
-        if response.ok:
-            return response.json(), True
-    except Exception as e:
-        print(f"Error fetching data from {endpoint}: {e}")
-    return None, False
-    
-def check_access(instance, request):
-    """Check if current user has access to the instance"""
-    # Get email from query params
-    user_email = request.args.get('email')
-    
-    # Try to fetch allowed_users from local instance
-    try:
-        response = requests.get(f"{instance.local_url}/api/allowed_users", timeout=3)
-        if response.ok:
-            allowed_users = response.json().get('allowed_users', [])
-            # If no allowed users set, allow all access
-            if not allowed_users:
-                return True
-            # Check if user email is in allowed users
-            return user_email in allowed_users
-    except Exception as e:
-        print(f"Error checking access: {e}")
-    
-    # If we can't get the allowed users list, default to allowing access
-    # You might want to change this based on your security requirements
-    return True
+    ref = instance.ref()
+    if endpoint == 'files_data' and params:
+        params = listing_fetch_params(ref.id, params)
+    deadline = time.monotonic() + app.config['UPSTREAM_PAGE_DEADLINE']
+    key = snapshot_key(ref.id, endpoint, params)
+    entry = snapshot_cache.get(key)
+    if entry is None:
+        stored = load_stored_snapshot(instance, endpoint, params)
+        if stored:
+            snapshot_cache.put(key, stored.data, stored.synced_at, stored.content_hash, stored.validators)
+            entry = snapshot_cache.get(key)
+    elif endpoint == 'files_data':
+        # Keeps folders viewed from memory out of store_directory's eviction
+        note_directory_access(ref.id, params)
+    age = time.monotonic() - entry.fetched_at if entry else None
+
+    # 'stale' promises a refresh is on its way; an instance that is not
+    # reachable only gets its cached copy shown as offline
+    old_status = 'stale' if liveness.is_online(ref.id) and breakers.get(ref.id).is_closed() \
+        else 'offline'
+    served = None  # SnapshotCache.Entry the page will show
+    data_future = None
+    if entry and age <= snapshot_cache.ttl(endpoint):
+        served, status = entry, 'online'
+    elif entry and age <= snapshot_cache.stale_limit:
+        served, status = entry, old_status
+        submit_refresh(ref, endpoint, params)
+    else:
+        data_future = submit_refresh(ref, endpoint, params)
+
+    allowed = True
+    access_future = None
+    if check_acl:
+        cached = acl_cache.lookup(ref.id, user_email)
+        if cached is None:
+            access_future = upstream_flights.submit(('acl', ref.id), fetch_allowed_users, ref)
+        else:
+            allowed = cached
+
+    pending = [f for f in (data_future, access_future) if f is not None]
+    if pending:
+        wait(pending, timeout=max(0, deadline - time.monotonic()))
+
+    if access_future is not None:
+        if access_future.done():
+            allowed = access_from_list(ref.id, access_future.result(), user_email)
+        else:
+            print(f"Access check for {ref.username} missed the page deadline")
+
+    if data_future is not None:
+        data, is_fresh = None, False
+        if data_future.done():
+            data, is_fresh = data_future.result()
+        else:
+            print(f"Fetching {endpoint} for {ref.username} missed the page deadline")
+        if data:
+            # refresh_snapshot has just cached it, as the folder's first page
+            # if the instance sent the whole folder
+            if endpoint == 'files_data' and params:
+                key = snapshot_key(ref.id, endpoint, listing_fetch_params(ref.id, params))
+            served = snapshot_cache.get(key) or SnapshotCache.Entry(
+                data, time.monotonic(), datetime.utcnow(), snapshot_digest(data)[1], {}
+            )
+            # Not fresh: the cached copy, while another process refreshes it
+            status = 'online' if is_fresh else old_status
+        elif entry:
+            # Too old to serve as stale, but better than nothing
+            served, status = entry, 'offline'
+        else:
+            status = 'offline'
+
+    if served is None:
+        return PageData(allowed, None, status, None, None)
+    return PageData(allowed, served.data, status, served.synced_at, served.content_hash)
 
 def get_file_icon(filename):
     """Get appropriate Font Awesome icon for file type"""
@@ -378,23 +3323,160 @@ def get_dummy_files(path=''):
     
     return result
 
+def _size_bytes(size):
+    """Parse sizes such as '2.3 MB' for sorting; unknown formats sort first"""
+    units = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+    try:
+        number, unit = str(size).split()
+        return float(number) * units.get(unit.upper(), 1)
+    except (ValueError, AttributeError):
+        return 0
+
+def listing_window(listing, offset, limit, sort='name', order='asc', icons=True):
+    """Select one page of rows from a files_data listing
+
+    Instances that paginate themselves return just the requested window plus
+    a 'total' count, which is used as is. Older instances return the whole
+    folder; that is sorted (folders first) and sliced here.
+
+    Returns:
+        (rows, total, next_offset) where rows is a list of (kind, item) and
+        next_offset is None on the last page
+    """
+    structure = listing.get('structure') or {}
+    folders = structure.get('folders', [])
+    files = structure.get('files', [])
+    if 'total' in listing:
+        rows = [('folder', f) for f in folders] + [('file', f) for f in files]
+        total = listing['total']
+        start = listing.get('offset', offset)
+    else:
+        sort_key = {
+            'name': lambda item: str(item.get('name', '')).lower(),
+            'size': lambda item: _size_bytes(item.get('size')),
+            'modified': lambda item: str(item.get('modified', '')),
+        }[sort]
+        reverse = order == 'desc'
+        everything = [('folder', f) for f in sorted(folders, key=sort_key, reverse=reverse)] \
+            + [('file', f) for f in sorted(files, key=sort_key, reverse=reverse)]
+        total = len(everything)
+        rows = everything[offset:offset + limit]
+        start = offset
+    # Icons are added to copies so the cached listing is never modified
+    if icons:
+        rows = [
+            (kind, item if kind == 'folder' or 'icon' in item
+             else {**item, 'icon': get_file_icon(item.get('name', ''))})
+            for kind, item in rows
+        ]
+    end = start + len(rows)
+    return rows, total, (end if rows and end < total else None)
+
+def listing_args():
+    """Paging and sorting query args of the file explorer"""
+    limit = request.args.get('limit', app.config['FILES_PAGE_SIZE'], type=int)
+    sort = request.args.get('sort', 'name')
+    return {
+        'path': request.args.get('path', '').strip('/'),
+        'offset': max(0, request.args.get('offset', 0, type=int)),
+        'limit': max(1, min(limit, app.config['FILES_MAX_PAGE_SIZE'])),
+        'sort': sort if sort in LISTING_SORT_KEYS else 'name',
+        'order': 'desc' if request.args.get('order') == 'desc' else 'asc',
+    }
+
+def access_args():
+    """Query args that carry the viewer's identity on to linked pages"""
+    return {'email': request.args['email']} if request.args.get('email') else {}
+
+def make_listing_url(username, params, **changes):
+    query = {**params, **changes, **access_args()}
+    endpoint = '/files/rows' if query.pop('rows', None) else '/files'
+    return f"/{username}{endpoint}?{urlencode(query)}"
+
+def remove_instance(instance):
+    """Delete an instance with its snapshots and drop it from every cache
+
+    The caller commits.
+    """
+    upstream.discard(instance.local_url)
+    apply_invalidation(instance.id, 'removed')
+    invalidations.broadcast(instance.id, 'removed')
+    shared_delete(f"acl:{instance.id}")
+    InstanceSnapshot.query.filter_by(instance_id=instance.id).delete()
+    DirectorySnapshot.query.filter_by(instance_id=instance.id).delete()
+    db.session.delete(instance)
+
+def reap_dead_instances(retention):
+    """Remove instances without a heartbeat for longer than retention
+
+    Returns:
+        list of ('removed', instance_id, username) events
+    """
+    cutoff = datetime.utcnow() - retention
+    def reap():
+        events = []
+        for instance in ExposedInstance.query.filter(ExposedInstance.last_heartbeat < cutoff).all():
+            seen = heartbeats.last_seen(instance.id)
+            if seen and seen >= cutoff:
+                continue  # heartbeat not flushed yet
+            events.append(('removed', instance.id, instance.username))
+            remove_instance(instance)
+        return events
+    try:
+        return db_writer.run(reap)
+    except Exception as e:
+        print(f"Error removing dead instances: {e}")
+        return []
+
+def active_instances(after=None, prefix=None, limit=60):
+    """One page of instances that sent a heartbeat within HEARTBEAT_TIMEOUT
+
+    Read from the liveness tracker's in-memory active set. Pages are ordered
+    by username; pass the returned cursor as after= to get the next one.
+
+    Returns:
+        (rows, next_cursor) tuple, next_cursor is None on the last page
+    """
+    return liveness.online_page(after=after, prefix=prefix, limit=limit)
+
+def index_page_args():
+    limit = request.args.get('limit', app.config['INDEX_PAGE_SIZE'], type=int)
+    return {
+        'after': request.args.get('after') or None,
+        'prefix': request.args.get('q') or None,
+        'limit': max(1, min(limit, app.config['INDEX_MAX_PAGE_SIZE'])),
+    }
+
 # Routes
 @app.route('/')
 def index():
     try:
-        instances = ExposedInstance.query.all()
-        active_instances = [
-            instance for instance in instances
-            if (datetime.utcnow() - instance.last_heartbeat).total_seconds() <= 300
-        ]
+        args = index_page_args()
+        instances, next_cursor = active_instances(**args)
         
-        return render_template_string(
-            INDEX_TEMPLATE,
-            instances=active_instances
+        return render_template(
+            'index.html',
+            instances=instances,
+            next_cursor=next_cursor,
+            prefix=args['prefix']
         )
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/instances')
+def list_instances():
+    try:
+        instances, next_cursor = active_instances(**index_page_args())
+        return jsonify({
+            'instances': [
+                {'username': row.username, 'last_heartbeat': row.last_heartbeat.isoformat()}
+                for row in instances
+            ],
+            'next': next_cursor
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 
 @app.route('/<username>/home')
 def user_home(username):
@@ -402,119 +3484,16 @@ def user_home(username):
     if not instance:
         return jsonify({'error': 'User not found'}), 404
 
-    if not check_access(instance, request):
-        return render_template_string("""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>Access Required</title>
-                <script src="https://cdn.tailwindcss.com"></script>
-            </head>
-            <body class="bg-gray-100">
-                <div class="container mx-auto px-4 py-8">
-                    <div class="bg-white shadow-md rounded px-8 pt-6 pb-8 mb-4">
-                        <h1 class="text-2xl font-bold mb-4">Access Required</h1>
-                        <p class="mb-4">Please enter your email to access this instance:</p>
-                        <form method="GET" class="space-y-4">
-                            <input type="email" name="email" placeholder="Enter your email" 
-                                    class="w-full px-3 py-2 border rounded" required>
-                            <button type="submit" 
-                                    class="bg-blue-500 text-white px-4 py-2 rounded hover:bg-blue-600">
-                                Submit
-                            </button>
-                        </form>
-                    </div>
-                </div>
-            </body>
-            </html>
-        """)
-
-    data, is_fresh = fetch_local_data(instance, 'home_data')
-    if data:
-        instance.home_data = data
-        instance.last_data_sync = datetime.utcnow()
-        db.session.commit()
-    elif instance.home_data:
-        data = instance.home_data
-    else:
-        data = {"message": "No data available"}
-
-    # Create the connections section
-    connections_section = '<div class="text-gray-500 italic">No connections configured</div>'
-    if data.get('connections_data'):
-        connections_section = '<div class="grid grid-cols-2 gap-3">'
-        for k in data['connections_data'].keys():
-            connections_section += f'<div class="bg-gray-50 p-3 rounded">{k}</div>'
-        connections_section += '</div>'
-
-    # Create the apps section
-    apps_section = '<div class="text-gray-500 italic">No apps installed</div>'
-    if data.get('apps'):
-        apps_section = '<div class="grid grid-cols-2 gap-3">'
-        for k in data['apps'].keys():
-            apps_section += f'<div class="bg-gray-50 p-3 rounded">{k}</div>'
-        apps_section += '</div>'
-
-    # Create the sequences section
-    sequences_section = '<div class="text-gray-500 italic">No sequences defined</div>'
-    if data.get('sequences'):
-        sequences_section = ''
-        for seq_name, seq_data in data['sequences'].items():
-            sequences_section += f'''
-                <div class="mb-4 last:mb-0">
-                    <div class="font-medium text-lg mb-2">{seq_name}</div>
-                    <div class="bg-gray-50 p-4 rounded">
-                        <div class="space-y-2">
-            '''
-            for action in seq_data:
-                icon = 'code' if action['type'] == 'actions' else 'cog'
-                sequences_section += f'''
-                    <div class="flex items-center space-x-2">
-                        <span class="text-blue-500">
-                            <i class="fas fa-{icon}"></i>
-                        </span>
-                        <span class="font-medium">{action['name']}</span>
-                    </div>
-                '''
-            sequences_section += '''
-                        </div>
-                    </div>
-                </div>
-            '''
-
-    content = f'''
-        <div class="space-y-6">
-            <div class="flex items-center space-x-4">
-                <div class="text-2xl font-bold text-gray-700">{data.get('name', username)}'s Dashboard</div>
-            </div>
-            
-            <div class="grid grid-cols-1 md:grid-cols-2 gap-6">
-                <div class="bg-white p-6 rounded-lg shadow">
-                    <h2 class="text-xl font-semibold mb-4 text-gray-700">
-                        <i class="fas fa-plug mr-2"></i>Connections
-                    </h2>
-                    {connections_section}
-                </div>
-
-                <div class="bg-white p-6 rounded-lg shadow">
-                    <h2 class="text-xl font-semibold mb-4 text-gray-700">
-                        <i class="fas fa-cube mr-2"></i>Apps
-                    </h2>
-                    {apps_section}
-                </div>
-            </div>
+    page = fetch_page_data(instance, 'home_data', user_email=request.args.get('email'))
+    if not page.allowed:
+        return access_required_page()
 
-            <div class="bg-white p-6 rounded-lg shadow">
-                <h2 class="text-xl font-semibold mb-4 text-gray-700">
-                    <i class="fas fa-code-branch mr-2"></i>Sequences
-                </h2>
-                {sequences_section}
-            </div>
-        </div>
-    '''
-    
-    return render_page(username, "Home", content, 
-                      instance_status='online' if is_fresh else 'offline')
+    data = page.data or {"message": "No data available"}
+    return conditional_page(page, lambda: render_page(
+        "home.html", username, "Home",
+        instance_status=page.status, synced_at=page.synced_at, data=data,
+        live_section='home'
+    ), 'home')
 
 
 @app.route('/<username>/files')
@@ -523,74 +3502,216 @@ def user_files(username):
     if not instance:
         return jsonify({'error': 'User not found'}), 404
     
-    if not check_access(instance, request):
-        return render_template_string("""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>Access Required</title>
-                <script src="https://cdn.tailwindcss.com"></script>
-            </head>
-            <body class="bg-gray-100">
-                <div class="container mx-auto px-4 py-8">
-                    <div class="bg-white shadow-md rounded px-8 pt-6 pb-8 mb-4">
-                        <h1 class="text-2xl font-bold mb-4">Access Required</h1>
-                        <p class="mb-4">Please enter your email to access this instance:</p>
-                        <form method="GET" class="space-y-4">
-                            <input type="email" name="email" placeholder="Enter your email" 
-                                   class="w-full px-3 py-2 border rounded" required>
-                            <button type="submit" 
-                                    class="bg-blue-500 text-white px-4 py-2 rounded hover:bg-blue-600">
-                                Submit
-                            </button>
-                        </form>
-                    </div>
-                </div>
-            </body>
-            </html>
-        """)
-        
-    path = request.args.get('path', '')
+    params = listing_args()
+    path = params['path']
     path_parts = path.strip('/').split('/') if path else []
     parent_path = '/'.join(path_parts[:-1]) if path_parts else ""
     
-    # Try to get real file data from local instance or cached data
-    data, is_fresh = fetch_local_data(instance, 'files_data', {'path': path})
-    
-    if data:
-        # Update cached data for this path
-        if not instance.files_data:
-            instance.files_data = {}
-        
-        instance.files_data = data
-        instance.last_data_sync = datetime.utcnow()
-        db.session.commit()
-        file_data = data.get('structure', {'folders': [], 'files': []})
-    elif instance.files_data:
-        # Use cached data if available
-        file_data = instance.files_data.get('structure', {'folders': [], 'files': []})
-    else:
-        # Fall back to dummy data if nothing is available
-        file_data = get_dummy_files(path)
+    # Try to get real file data from local instance or cached data; paging
+    # and sorting are forwarded so capable instances only send one window
+    page = fetch_page_data(
+        instance, 'files_data', params, user_email=request.args.get('email')
+    )
+    if not page.allowed:
+        return access_required_page()
     
-    # Add icons to file data
-    for file in file_data.get('files', []):
-        if 'icon' not in file:
-            file['icon'] = get_file_icon(file['name'])
+    # Fall back to dummy data if nothing is available
+    listing = page.data or {'structure': get_dummy_files(path)}
+    rows, total, next_offset = listing_window(
+        listing, params['offset'], params['limit'], params['sort'], params['order']
+    )
+    folder_prefetcher.note_view(instance.id, path)
+    if page.data and page.status != 'offline':
+        # Warm the subfolders the viewer is likely to open next
+        folder_prefetcher.after_listing(instance.ref(), path, rows)
     
-    # Render the file explorer template
-    content = render_template_string(
-        FILE_EXPLORER_TEMPLATE,
-        username=username,
-        file_data=file_data,
+    return conditional_page(page, lambda: render_page(
+        "files.html", username, "Files",
+        instance_status=page.status, synced_at=page.synced_at,
+        stream=len(rows) > app.config['FILES_STREAM_THRESHOLD'],
+        rows=rows,
+        total=total,
+        next_offset=next_offset,
+        sort=params['sort'],
+        order=params['order'],
+        listing_url=lambda **changes: make_listing_url(username, params, **changes),
+        live_section='files',
         current_path=path,
         current_path_prefix=path + '/' if path else '',
         parent_path=parent_path
+    ), 'files', tuple(sorted(params.items())))
+
+@app.route('/<username>/files/rows')
+def user_file_rows(username):
+    """HTML rows for one more page of a folder, appended by the explorer's Load more"""
+    instance = ExposedInstance.query.filter_by(username=username).first()
+    if not instance:
+        return jsonify({'error': 'User not found'}), 404
+    
+    params = listing_args()
+    page = fetch_page_data(
+        instance, 'files_data', params, user_email=request.args.get('email')
+    )
+    if not page.allowed:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    listing = page.data or {'structure': get_dummy_files(params['path'])}
+    rows, total, next_offset = listing_window(
+        listing, params['offset'], params['limit'], params['sort'], params['order']
+    )
+    context = dict(
+        username=username,
+        rows=rows,
+        access_args=access_args(),
+        current_path_prefix=params['path'] + '/' if params['path'] else ''
     )
+    if len(rows) > app.config['FILES_STREAM_THRESHOLD']:
+        response = app.response_class(stream_template('file_rows.html', **context), mimetype='text/html')
+    else:
+        response = app.make_response(render_template('file_rows.html', **context))
+    if next_offset is not None:
+        response.headers['X-Next-Url'] = make_listing_url(username, params, offset=next_offset, rows=1)
+        response.headers['X-Remaining'] = str(total - next_offset)
+    return response
+    
+
+@app.route('/<username>/files/search')
+def user_file_search(username):
+    """Search file and folder names in the instance's known directory tree
+
+    Answered from the in-memory index without contacting the local instance,
+    so it also works for offline instances. Only folders that have been
+    listed (viewed or pushed) are searchable.
+    """
+    instance = ExposedInstance.query.filter_by(username=username).first()
+    if not instance:
+        return jsonify({'error': 'User not found'}), 404
+    
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing q'}), 400
+    
+    if not check_access(instance, request):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    limit = request.args.get('limit', app.config['SEARCH_MAX_RESULTS'], type=int)
+    limit = max(1, min(limit, app.config['SEARCH_MAX_RESULTS']))
+    ensure_search_index(instance.id)
+    return jsonify({
+        'query': query,
+        'results': [entry._asdict() for entry in file_search.search(instance.id, query, limit)]
+    })
+
+@app.route('/<username>/files/download')
+def user_file_download(username):
+    """Stream a file from the local instance to the client
+
+    The body is relayed in DOWNLOAD_CHUNK_SIZE pieces as it arrives, so memory
+    use does not depend on the file size. Range and If-Range are passed
+    through, letting clients resume downloads or read parts of a file.
+    """
+    instance = ExposedInstance.query.filter_by(username=username).first()
+    if not instance:
+        return jsonify({'error': 'User not found'}), 404
+    
+    path = request.args.get('path', '').strip('/')
+    if not path:
+        return jsonify({'error': 'Missing path'}), 400
+    
+    if not check_access(instance, request):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    if not download_slots.acquire(instance.id):
+        response = jsonify({'error': 'Too many downloads in progress for this instance'})
+        response.headers['Retry-After'] = '5'
+        return response, 429
+    
+    # Identity encoding keeps byte ranges and Content-Length meaningful
+    headers = {'Accept-Encoding': 'identity'}
+    for name in DOWNLOAD_FORWARD_HEADERS:
+        if name in request.headers:
+            headers[name] = request.headers[name]
+    
+    try:
+        upstream_response = upstream_request(
+            instance, "/api/files/download",
+            params={'path': path},
+            headers=headers,
+            stream=True,
+            timeout=(app.config['DOWNLOAD_CONNECT_TIMEOUT'], app.config['DOWNLOAD_READ_TIMEOUT'])
+        )
+    except CircuitOpenError:
+        download_slots.release(instance.id)
+        return jsonify({'error': 'Instance unavailable'}), 503
+    except requests.RequestException:
+        download_slots.release(instance.id)
+        return jsonify({'error': 'Instance unreachable'}), 502
+    
+    if upstream_response.status_code not in (200, 206, 416):
+        status = upstream_response.status_code
+        upstream_response.close()
+        download_slots.release(instance.id)
+        if status == 404:
+            return jsonify({'error': 'File not found'}), 404
+        return jsonify({'error': 'Download failed'}), 502
+    
+    released = []
+    def release():
+        # Runs once, whether the body was fully sent or the client went away
+        if not released:
+            released.append(True)
+            upstream_response.close()
+            download_slots.release(instance.id)
     
-    return render_page(username, "Files", content, 
-                      instance_status='online' if is_fresh else 'offline')
+    def relay():
+        try:
+            for chunk in upstream_response.iter_content(chunk_size=app.config['DOWNLOAD_CHUNK_SIZE']):
+                if chunk:
+                    yield chunk
+        finally:
+            release()
     
+    response = app.response_class(relay(), status=upstream_response.status_code, direct_passthrough=True)
+    for name in DOWNLOAD_RELAY_HEADERS:
+        if name in upstream_response.headers:
+            response.headers[name] = upstream_response.headers[name]
+    if 'Content-Type' not in upstream_response.headers:
+        response.headers['Content-Type'] = 'application/octet-stream'
+    if 'Content-Disposition' not in response.headers:
+        response.headers.set('Content-Disposition', 'attachment', filename=path.rsplit('/', 1)[-1])
+    response.call_on_close(release)
+    return response
+
+def behavior_node(value, depth, offset=0):
+    """Describe value for the behaviors tree, listing children depth levels down
+
+    Containers list at most BEHAVIORS_NODE_MAX_CHILDREN children starting at
+    offset, and 'more' counts the rest; containers below depth only report
+    their type and size (children is None). Work is bounded by what is
+    listed, not by the size of the document.
+    """
+    if isinstance(value, dict):
+        node = {'type': 'object', 'size': len(value), 'children': None}
+        items = lambda: itertools.islice(value.items(), offset, None)
+    elif isinstance(value, list):
+        node = {'type': 'array', 'size': len(value), 'children': None}
+        items = lambda: ((str(i), v) for i, v in enumerate(itertools.islice(value, offset, None), offset))
+    else:
+        max_chars = app.config['BEHAVIORS_VALUE_MAX_CHARS']
+        truncated = isinstance(value, str) and len(value) > max_chars
+        text = value[:max_chars] if truncated else value
+        return {'type': 'value', 'value': json.dumps(text), 'truncated': truncated}
+    if depth <= 0:
+        return node
+    listed = itertools.islice(items(), app.config['BEHAVIORS_NODE_MAX_CHILDREN'])
+    node['children'] = [{'key': key, **behavior_node(child, depth - 1)} for key, child in listed]
+    node['offset'] = offset
+    node['more'] = max(0, node['size'] - offset - len(node['children']))
+    return node
+
+def behaviors_tree(data):
+    return behavior_node(data or {"message": "No behaviors data available"},
+                         app.config['BEHAVIORS_INITIAL_DEPTH'])
 
 @app.route('/<username>/behaviors')
 def user_behaviors(username):
@@ -598,25 +3719,419 @@ def user_behaviors(username):
     if not instance:
         return jsonify({'error': 'User not found'}), 404
 
-    data, is_fresh = fetch_local_data(instance, 'behaviors_data')
-    if data:
-        instance.behaviors_data = data
-        instance.last_data_sync = datetime.utcnow()
-        db.session.commit()
-    elif instance.behaviors_data:
-        data = instance.behaviors_data
+    page = fetch_page_data(instance, 'behaviors_data', check_acl=False)
+    # Only the top of the document is rendered; subtrees load on demand
+    return conditional_page(page, lambda: render_page(
+        "behaviors.html", username, "Behaviors",
+        instance_status=page.status, synced_at=page.synced_at, tree=behaviors_tree(page.data),
+        live_section='behaviors'
+    ), 'behaviors')
+
+@app.route('/<username>/behaviors/node')
+def user_behavior_node(username):
+    """One behaviors subtree as JSON, addressed by a JSON pointer (?path=/a/0)
+
+    Lists the node's children (up to BEHAVIORS_NODE_MAX_CHILDREN from
+    ?offset=) with their own children collapsed.
+    """
+    instance = ExposedInstance.query.filter_by(username=username).first()
+    if not instance:
+        return jsonify({'error': 'User not found'}), 404
+    
+    path = request.args.get('path', '')
+    offset = max(0, request.args.get('offset', 0, type=int))
+    page = fetch_page_data(instance, 'behaviors_data', check_acl=False)
+    if page.data is None:
+        return jsonify({'error': 'No data available', 'status': page.status}), 503
+    try:
+        value = _walk(page.data, _pointer_parts(path))
+    except PatchError as e:
+        return jsonify({'error': str(e)}), 404
+    return snapshot_api_response(page, ('node', path, offset), lambda data: behavior_node(value, 1, offset))
+
+def format_sse(event):
+    return f"id: {event.id}\nevent: {event.type}\ndata: {json.dumps(event.data)}\n\n"
+
+def events_since_arg():
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
+    try:
+        return int(since)
+    except (TypeError, ValueError):
+        return event_broker.last_id()
+
+@app.route('/<username>/events')
+def user_events(username):
+    """Server-sent events with page updates and status changes of an instance
+
+    Streams are capped at EVENTS_MAX_STREAMS per process and closed after
+    EVENTS_STREAM_MAX_AGE (the browser reconnects, which also re-checks
+    access). Above the cap clients get 503 and switch to /events/poll. See
+    limit_event_streams for servers with a thread per request.
+    """
+    instance = ExposedInstance.query.filter_by(username=username).first()
+    if not instance:
+        return jsonify({'error': 'User not found'}), 404
+    if not check_access(instance, request):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    instance_id = instance.id
+    since = events_since_arg()
+    invalidations.ensure_listening()  # snapshots stored by other processes
+    if not event_broker.open_stream(app.config['EVENTS_MAX_STREAMS']):
+        return jsonify({'error': 'Too many live connections, use long-polling',
+                        'poll': f"/{username}/events/poll"}), 503
+    subscription = event_broker.subscribe(instance_id)
+    
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            for event in event_broker.since(instance_id, since):
+                yield format_sse(event)
+            sent = since
+            closes_at = time.monotonic() + app.config['EVENTS_STREAM_MAX_AGE']
+            while time.monotonic() < closes_at and not subscription.dropped:
+                try:
+                    event = subscription.queue.get(timeout=app.config['EVENTS_KEEPALIVE'])
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event.id > sent:
+                    sent = event.id
+                    yield format_sse(event)
+        finally:
+            event_broker.unsubscribe(instance_id, subscription)
+            event_broker.close_stream()
+    
+    response = app.response_class(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # keep nginx from buffering the stream
+    return response
+
+@app.route('/<username>/events/poll')
+def user_events_poll(username):
+    """Long-poll fallback for /events: waits up to EVENTS_POLL_TIMEOUT for new events
+
+    With EVENTS_POLL_TIMEOUT at 0 it answers at once and tells the client to
+    poll again after 'retry' seconds.
+    """
+    instance = ExposedInstance.query.filter_by(username=username).first()
+    if not instance:
+        return jsonify({'error': 'User not found'}), 404
+    if not check_access(instance, request):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    since = events_since_arg()
+    invalidations.ensure_listening()
+    event_broker.note_poll(instance.id)
+    events = event_broker.since(instance.id, since)
+    timeout = app.config['EVENTS_POLL_TIMEOUT']
+    if not events and timeout > 0:
+        subscription = event_broker.subscribe(instance.id)
+        try:
+            # Re-check after subscribing so nothing published in between is missed
+            events = event_broker.since(instance.id, since)
+            if not events:
+                try:
+                    events = [subscription.queue.get(timeout=timeout)]
+                except queue.Empty:
+                    pass
+        finally:
+            event_broker.unsubscribe(instance.id, subscription)
+    return jsonify({
+        'events': [event._asdict() for event in events],
+        'last': events[-1].id if events else since,
+        'retry': 0 if timeout > 0 else app.config['EVENTS_POLL_INTERVAL']
+    })
+
+def project_fields(data, fields):
+    """Keep only the given fields of data; 'a.b' selects key b inside a"""
+    result = {}
+    for field in fields:
+        source, target = data, result
+        parts = field.split('.')
+        for i, part in enumerate(parts):
+            if not isinstance(source, dict) or part not in source:
+                break
+            if i == len(parts) - 1:
+                target[part] = source[part]
+            else:
+                source = source[part]
+                target = target.setdefault(part, {})
+                if not isinstance(target, dict):
+                    break
+    return result
+
+def api_files_body(listing, params):
+    """files_data document for one listing window, in the instance's format"""
+    if 'total' in listing:
+        return listing  # already paginated by the instance
+    rows, total, _ = listing_window(
+        listing, params['offset'], params['limit'], params['sort'], params['order'], icons=False
+    )
+    return {
+        'path': params['path'],
+        'structure': {
+            'folders': [item for kind, item in rows if kind == 'folder'],
+            'files': [item for kind, item in rows if kind == 'file'],
+        },
+        'total': total,
+        'offset': params['offset'],
+        'limit': params['limit'],
+    }
+
+def snapshot_api_response(page, variant, build):
+    """JSON response for a snapshot, answered from pre-encoded bytes when possible
+
+    The strong ETag is the snapshot's content hash plus the projection and
+    window (variant), and the content coding for compressed bodies, since
+    each coding is a different byte sequence. Clients that accept no
+    compression get a 304 without any encoding; the others need the JSON
+    body's size, which is cached with the encoded and compressed bodies
+    under the same key.
+    """
+    if page.data is None:
+        return jsonify({'error': 'No data available', 'status': page.status}), 503
+    etag = page.content_hash if not variant else \
+        hashlib.sha1(repr((page.content_hash,) + variant).encode()).hexdigest()
+    def json_body():
+        return api_bodies.get_or_encode((page.content_hash, variant), lambda: dumps_json(build(page.data)))
+    body = None
+    encoding = preferred_encoding()
+    if encoding:
+        body = json_body()
+        if len(body) < app.config['COMPRESS_MIN_SIZE']:
+            encoding = None
+        else:
+            etag = f"{etag}-{encoding}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
     else:
-        data = {"message": "No behaviors data available"}
+        body = body if body is not None else json_body()
+        if encoding == 'br':
+            body = api_bodies.get_or_encode((page.content_hash, variant, encoding), lambda: brotli.compress(
+                body, quality=app.config['COMPRESS_BROTLI_QUALITY']))
+        elif encoding == 'gzip':
+            body = api_bodies.get_or_encode((page.content_hash, variant, encoding), lambda: gzip.compress(
+                body, compresslevel=app.config['COMPRESS_GZIP_LEVEL']))
+        response = app.response_class(body, mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    if page.synced_at:
+        response.last_modified = page.synced_at
+    response.cache_control.no_cache = True
+    response.headers['X-Instance-Status'] = page.status
+    return response
 
-    content = f"""
-        <div class="space-y-4">
-            <div class="text-lg">Behaviors</div>
-            <pre class="bg-gray-100 p-4 rounded overflow-auto">{str(data)}</pre>
-        </div>
+def api_fields():
+    return tuple(sorted(f.strip() for f in request.args.get('fields', '').split(',') if f.strip()))
+
+def api_snapshot(username, endpoint, params=None, check_acl=True, build=None):
+    instance = ExposedInstance.query.filter_by(username=username).first()
+    if not instance:
+        return jsonify({'error': 'User not found'}), 404
+    
+    page = fetch_page_data(
+        instance, endpoint, params, user_email=request.args.get('email'), check_acl=check_acl
+    )
+    if not page.allowed:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    fields = api_fields()
+    variant = (tuple(sorted(params.items())) if params else ()) + fields
+    def encode(data):
+        if build:
+            data = build(data)
+        return project_fields(data, fields) if fields else data
+    return snapshot_api_response(page, variant, encode)
+
+@app.route('/api/v1/<username>/home')
+def api_home(username):
+    """home_data snapshot as JSON; ?fields=name,apps selects top-level (or dotted) keys"""
+    return api_snapshot(username, 'home_data')
+
+@app.route('/api/v1/<username>/files')
+def api_files(username):
+    """One folder listing window as JSON, with the explorer's path/offset/limit/sort/order args"""
+    params = listing_args()
+    return api_snapshot(username, 'files_data', params, build=lambda data: api_files_body(data, params))
+
+@app.route('/api/v1/<username>/behaviors')
+def api_behaviors(username):
+    """behaviors_data snapshot as JSON"""
+    return api_snapshot(username, 'behaviors_data', check_acl=False)
+
+def register_job(user_id, username, local_url, initial_data):
+    """Create or update an instance row and store its initial data (runs on db_writer)
+
+    Returns:
+        (InstanceRef, to_dict() of the row, stored snapshots, snapshot hashes)
     """
+    # Check if instance already exists
+    instance = ExposedInstance.query.filter_by(username=username).first()
+    if instance:
+        if instance.local_url != local_url:
+            # Connections and snapshots from the old address are useless now
+            upstream.discard(instance.local_url)
+            apply_invalidation(instance.id, 'moved')
+            invalidations.broadcast(instance.id, 'moved')
+        instance.local_url = local_url
+        instance.last_heartbeat = datetime.utcnow()
+    else:
+        instance = ExposedInstance(
+            user_id=user_id,
+            username=username,
+            local_url=local_url,
+            token=str(uuid.uuid4()),
+            last_heartbeat=datetime.utcnow()
+        )
+        db.session.add(instance)
+    db.session.flush()  # new instances need an id for their snapshot rows
     
-    return render_page(username, "Behaviors", content,
-                      instance_status='online' if is_fresh else 'offline')
+    # Store initial data if provided (full documents or delta sync items)
+    stored = []
+    if initial_data:
+        stored = apply_pushed_payload(instance, initial_data, datetime.utcnow())
+    db.session.flush()
+    return instance.ref(), instance.to_dict(), stored, snapshot_hashes(instance.id), instance.last_data_sync
+
+def store_heartbeat_payload(instance_id, payload, at):
+    """Apply a heartbeat's access list, snapshots and time (runs on db_writer)
+
+    Raises SyncConflict if a sync item does not match. No snapshot is written
+    then, but the access list and heartbeat time have already been applied.
+
+    Returns:
+        (InstanceRef, stored snapshots, snapshot hashes), or None if the
+        instance is gone
+    """
+    instance = db.session.get(ExposedInstance, instance_id)
+    if instance is None:
+        return None
+    share_acl_push(instance_id, payload)
+    instance.last_heartbeat = at
+    stored = apply_pushed_payload(instance, payload, at)
+    db.session.flush()
+    return instance.ref(), stored, snapshot_hashes(instance_id)
+
+def store_heartbeat_batch(items, at):
+    """Apply several heartbeat payloads in one transaction (runs on db_writer)
+
+    Each payload is applied in its own savepoint, so one that fails leaves
+    the others written. A payload whose sync items conflict stores no
+    snapshots, but its heartbeat and access list still count.
+
+    Args:
+        items: list of (instance_id, payload)
+
+    Returns:
+        list aligned with items of store_heartbeat_payload() results,
+        (SyncConflict, snapshot hashes) for payloads that did not apply, or
+        the exception a payload failed with
+    """
+    # One query loads every instance into the session for the lookups below
+    ExposedInstance.query.filter(ExposedInstance.id.in_({i for i, _ in items})).all()
+    results = []
+    for instance_id, payload in items:
+        try:
+            with db.session.begin_nested():
+                try:
+                    result = store_heartbeat_payload(instance_id, payload, at)
+                except SyncConflict as e:
+                    result = (e, snapshot_hashes(instance_id))
+        except Exception as e:
+            if not isinstance(e, InvalidPayload):
+                print(f"Error storing heartbeat of instance {instance_id}: {e}")
+            result = e
+        results.append(result)
+    return results
+
+def share_acl_pushes(pushes):
+    """Apply the access list pushes of several heartbeats (runs on db_writer)"""
+    for instance_id, payload in pushes:
+        try:
+            with db.session.begin_nested():
+                share_acl_push(instance_id, payload)
+        except Exception as e:
+            print(f"Error sharing access list of instance {instance_id}: {e}")
+
+def has_snapshot_payload(data):
+    """Whether a heartbeat carries snapshots or sync items to store"""
+    return isinstance(data, dict) and bool(data) and (
+        bool(data.get('sync')) or any(data.get(e) is not None for e in SNAPSHOT_ENDPOINTS)
+    )
+
+def process_heartbeats(entries, now):
+    """Handle (token, payload) heartbeats; returns one (status code, body) per entry
+
+    Tokens are resolved together. Payloads are written in one writer job.
+    Everything else is a liveness ping for the write-behind recorder; access
+    list pushes it carries are shared in one more job, unless acl_cache
+    already holds them, so repeating the same acl_version writes nothing.
+    """
+    ids = heartbeats.resolve_tokens([token for token, _ in entries])
+    results = [None] * len(entries)
+    writes = []  # (entry index, instance_id, payload)
+    acl_pushes = []  # (instance_id, payload)
+    for index, (token, data) in enumerate(entries):
+        instance_id = ids.get(token)
+        if instance_id is None:
+            results[index] = (404, {'error': 'Instance not found'})
+            continue
+        try:
+            if data:
+                check_payload(data)
+        except InvalidPayload as e:
+            results[index] = (400, {'error': str(e)})
+            continue
+        if has_snapshot_payload(data):
+            writes.append((index, instance_id, data))
+            continue
+        if data and ('allowed_users' in data or data.get('acl_version') is not None):
+            if acl_cache.holds(instance_id, data):
+                acl_cache.apply_push(instance_id, data)  # keeps a repeated list fresh
+            else:
+                acl_pushes.append((instance_id, data))
+        # Liveness ping: the recorder writes it with the next batch
+        heartbeats.record(instance_id, now)
+        results[index] = (200, {'status': 'ok'})
+    if acl_pushes:
+        db_writer.run(share_acl_pushes, acl_pushes)
+    if writes:
+        written = db_writer.run(store_heartbeat_batch, [(i, d) for _, i, d in writes], now)
+        for (index, instance_id, data), result in zip(writes, written):
+            if result is None:
+                results[index] = (404, {'error': 'Instance not found'})
+            elif isinstance(result, InvalidPayload):
+                results[index] = (400, {'error': str(result)})
+            elif isinstance(result, Exception):
+                results[index] = (500, {'error': str(result)})
+            elif isinstance(result[0], SyncConflict):
+                heartbeats.record(instance_id, now, persisted=True)
+                results[index] = (409, {
+                    'error': 'Snapshot version mismatch',
+                    'conflicts': result[0].conflicts,
+                    'snapshots': result[1]
+                })
+            else:
+                ref, stored, hashes = result
+                heartbeats.record(instance_id, now, persisted=True)
+                cache_stored_snapshots(ref, stored, now)
+                body = {'status': 'ok'}
+                if has_snapshot_payload(data):
+                    body['snapshots'] = hashes
+                results[index] = (200, body)
+    return results
+
+def deregister_job(token):
+    """Remove the instance owning token (runs on db_writer); returns its username or None"""
+    instance = ExposedInstance.query.filter_by(token=token).first()
+    if instance is None:
+        return None
+    username = instance.username  # Store username for logging
+    remove_instance(instance)
+    return username
 
 @app.route('/register', methods=['POST'])
 def register_instance():
@@ -633,76 +4148,114 @@ def register_instance():
         if not all([user_id, username, local_url]):
             return jsonify({'error': 'Missing required fields'}), 400
         
-        # Check if instance already exists
-        instance = ExposedInstance.query.filter_by(username=username).first()
-        if instance:
-            instance.local_url = local_url
-            instance.last_heartbeat = datetime.utcnow()
-        else:
-            instance = ExposedInstance(
-                user_id=user_id,
-                username=username,
-                local_url=local_url,
-                token=str(uuid.uuid4())
-            )
-            db.session.add(instance)
-        
-        # Store initial data if provided
-        if initial_data:
-            instance.home_data = initial_data.get('home_data')
-            instance.files_data = initial_data.get('files_data')
-            instance.behaviors_data = initial_data.get('behaviors_data')
-            instance.last_data_sync = datetime.utcnow()
-        
-        db.session.commit()
-        return jsonify(instance.to_dict()), 200
+        ref, instance_data, stored, hashes, synced_at = db_writer.run(
+            register_job, user_id, username, local_url, initial_data
+        )
+        liveness.beat(ref.id, ref.last_heartbeat, ref.username)
+        heartbeats.record(ref.id, ref.last_heartbeat, persisted=True)
+        cache_stored_snapshots(ref, stored, synced_at)
+        return jsonify({**instance_data, 'snapshots': hashes}), 200
+    except InvalidPayload as e:
+        return jsonify({'error': str(e)}), 400
+    except SyncConflict as e:
+        return jsonify({'error': 'Snapshot version mismatch', 'conflicts': e.conflicts}), 409
     except Exception as e:
-        db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 @app.route('/heartbeat/<token>', methods=['POST'])
 def heartbeat(token):
     try:
-        instance = ExposedInstance.query.filter_by(token=token).first()
-        if not instance:
-            return jsonify({'error': 'Instance not found'}), 404
-        
-        instance.last_heartbeat = datetime.utcnow()
-        
-        # Update instance data if provided
-        if request.is_json:
-            data = request.json
-            if data:
-                if 'home_data' in data:
-                    instance.home_data = data['home_data']
-                if 'files_data' in data:
-                    instance.files_data = data['files_data']
-                if 'behaviors_data' in data:
-                    instance.behaviors_data = data['behaviors_data']
-                instance.last_data_sync = datetime.utcnow()
+        data = request.json if request.is_json else None
+        if not isinstance(data, dict):
+            data = None  # any other JSON body is a plain ping, as it always was
+        status, body = process_heartbeats([(token, data)], datetime.utcnow())[0]
+        return jsonify(body), status
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/heartbeat/batch', methods=['POST'])
+def heartbeat_batch():
+    """Heartbeats for many instances, e.g. from a relay fronting a LAN
+
+    The body is {'heartbeats': [...]}, each item being what the instance
+    would POST to /heartbeat/<token> plus its 'token'. The response lists a
+    result per item, in order: {'token', 'code'} plus the body the single
+    endpoint would have returned.
+    """
+    try:
+        data = request.json if request.is_json else None
+        items = data.get('heartbeats') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not all(
+                isinstance(item, dict) and isinstance(item.get('token'), str) for item in items):
+            return jsonify({'error': "Expected {'heartbeats': [{'token': ...}, ...]}"}), 400
+        if len(items) > app.config['HEARTBEAT_BATCH_MAX']:
+            return jsonify({'error': f"At most {app.config['HEARTBEAT_BATCH_MAX']} heartbeats per batch"}), 413
         
-        db.session.commit()
-        return jsonify({'status': 'ok'}), 200
+        entries = [(item['token'], {k: v for k, v in item.items() if k != 'token'}) for item in items]
+        results = process_heartbeats(entries, datetime.utcnow())
+        return jsonify({'results': [
+            {'token': token, 'code': status, **body}
+            for (token, _), (status, body) in zip(entries, results)
+        ]}), 200
     except Exception as e:
-        db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/sync/<token>')
+def sync_state(token):
+    """Content hashes of the snapshots held for an instance (delta sync step one)"""
+    instance_id = heartbeats.resolve_token(token)
+    if instance_id is None:
+        return jsonify({'error': 'Instance not found'}), 404
+    return jsonify({'snapshots': snapshot_hashes(instance_id)}), 200
+
 @app.route('/deregister/<token>', methods=['DELETE'])
 def deregister_instance(token):
     try:
-        instance = ExposedInstance.query.filter_by(token=token).first()
-        if instance:
-            username = instance.username  # Store username for logging
-            db.session.delete(instance)
-            db.session.commit()
+        username = db_writer.run(deregister_job, token)
+        if username is not None:
             print(f"Successfully deregistered instance for user: {username}")
             return jsonify({'status': 'Instance deregistered successfully'}), 200
         return jsonify({'error': 'Instance not found'}), 404
     except Exception as e:
-        db.session.rollback()
         print(f"Error during deregistration: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/status/<username>')
+def instance_status(username):
+    instance = ExposedInstance.query.filter_by(username=username).first()
+    if not instance:
+        return jsonify({'error': 'User not found'}), 404
+    return jsonify({
+        'username': instance.username,
+        'online': instance.is_online(),
+        'last_heartbeat': instance.heartbeat_at().isoformat(),
+        'last_data_sync': instance.last_data_sync.isoformat() if instance.last_data_sync else None,
+        'breaker': breakers.get(instance.id).to_dict()
+    }), 200
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli-encode text responses larger than COMPRESS_MIN_SIZE"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code not in (200, 201)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    encoding = preferred_encoding()
+    if encoding == 'br':
+        body = brotli.compress(body, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    elif encoding == 'gzip':
+        body = gzip.compress(body, compresslevel=app.config['COMPRESS_GZIP_LEVEL'])
+    else:
+        return response
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
 @app.errorhandler(404)
 def not_found(e):
     return jsonify({'error': 'Not found'}), 404
@@ -712,5 +4265,6 @@ def server_error(e):
     return jsonify({'error': 'Internal server error'}), 500
 
 if __name__ == '__main__':
+    check_templates()
     create_tables()
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,62 @@
+# Production entry point for the exposure server
+#
+#   cd expose_server && gunicorn -c gunicorn.conf.py
+#
+# Runs one gevent worker process per core (EXPOSE_WORKERS to override), so
+# requests waiting on local instances and idle /events streams cost a
+# greenlet rather than a thread. Tables are
+# created once in the master before any worker starts. Workers keep their own
+# in-memory caches and share snapshots, access lists, refresh leases and
+# invalidations through the database (see SharedCacheEntry and
+# InvalidationLog in app.py).
+import multiprocessing
+import os
+import subprocess
+import sys
+
+wsgi_app = 'app:app'
+bind = os.environ.get('EXPOSE_BIND', '0.0.0.0:5000')
+
+workers = int(os.environ.get('EXPOSE_WORKERS', multiprocessing.cpu_count()))
+# Most request time is spent waiting on local instances, not on the CPU, and
+# every open /events stream stays connected for minutes. gevent keeps
+# thousands of them per worker (worker_connections). EXPOSE_WORKER_CLASS=gthread
+# does not: there each stream holds one of `threads`, so streams are capped
+# at half of them and the remaining tabs short-poll (post_worker_init).
+worker_class = os.environ.get('EXPOSE_WORKER_CLASS', 'gevent')
+worker_connections = int(os.environ.get('EXPOSE_WORKER_CONNECTIONS', 2000))
+threads = int(os.environ.get('EXPOSE_THREADS', 16))
+
+# The app is imported in each worker after fork, so background threads,
+# connection pools and caches are never shared between processes
+preload_app = False
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+
+def on_starting(server):
+    """Create and migrate tables once, before the workers are forked
+
+    Runs in a child process so the master never imports the app; workers
+    would otherwise inherit its module state and database connections.
+    """
+    subprocess.run(
+        [sys.executable, '-c', 'from app import check_templates, create_tables; '
+                               'check_templates(); create_tables()'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True
+    )
+
+
+def post_worker_init(worker):
+    """Tell the app how many processes share the database
+
+    Also keeps live update streams from taking every request thread of a
+    worker.
+    """
+    from gunicorn.workers.base_async import AsyncWorker
+    from app import app, limit_event_streams
+    app.config['WORKER_PROCESSES'] = worker.cfg.workers
+    if not isinstance(worker, AsyncWorker):
+        limit_event_streams(worker.cfg.threads)
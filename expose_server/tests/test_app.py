@@ -0,0 +1,695 @@
+import os
+import sys
+import tempfile
+import threading
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import event
+
+# The app reads DATABASE_URL at import time; keep tests away from the real DB
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as server  # noqa: E402
+from app import CircuitBreaker, FileSearchIndex, PatchError, apply_json_patch  # noqa: E402
+
+
+# Circuit breaker
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure('error', 0.1)
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+    breaker.record_failure('timeout', 0.1)
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    assert breaker.counters['rejected'] == 1
+
+
+def test_breaker_success_resets_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure('error', 0.1)
+    breaker.record_success(0.1)
+    breaker.record_failure('error', 0.1)
+    assert breaker.state == 'closed'
+
+
+def test_breaker_slow_calls_count_as_failures():
+    breaker = CircuitBreaker(failure_threshold=1, slow_call_seconds=1)
+    breaker.record_success(2)
+    assert breaker.state == 'open'
+    assert breaker.counters['slow_calls'] == 1
+
+
+def test_breaker_half_open_probe():
+    breaker = CircuitBreaker(failure_threshold=1, open_seconds=30)
+    breaker.record_failure('error', 0.1)
+    breaker.opened_at -= 31
+    assert breaker.allow()  # the single probe
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+    breaker.record_failure('error', 0.1)
+    assert breaker.state == 'open'
+
+    breaker.opened_at -= 31
+    assert breaker.allow()
+    breaker.record_success(0.1)
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_breaker_follows_heartbeats():
+    breaker = CircuitBreaker(heartbeat_timeout=300)
+    assert not breaker.allow(heartbeat_age=301)
+    assert breaker.state == 'open' and breaker.reason == 'heartbeat'
+    assert breaker.allow(heartbeat_age=1)  # heartbeats resumed: probe at once
+    breaker.record_success(0.1)
+    assert breaker.state == 'closed'
+
+
+# Heartbeats
+
+@pytest.fixture(scope='module')
+def client():
+    server.create_tables()
+    return server.app.test_client()
+
+
+@pytest.fixture
+def token(client, request):
+    username = request.node.name.replace('[', '_').replace(']', '')
+    response = client.post('/register', json={
+        'user_id': 1, 'username': username, 'local_url': 'http://127.0.0.1:1',
+        'initial_data': {'home_data': {'name': 'Ann', 'apps': {'a': 1}}}
+    })
+    assert response.status_code == 200
+    return response.json['token']
+
+
+def resolve_token(token):
+    with server.app.app_context():
+        return server.heartbeats.resolve_token(token)
+
+
+def test_plain_heartbeats_are_written_in_batches(client, token):
+    instance_id = resolve_token(token)
+    with server.app.app_context():
+        engine = server.db.engine
+    updates = []
+
+    def note_update(conn, cursor, statement, *args):
+        if threading.current_thread() is threading.main_thread() and statement.lstrip().startswith('UPDATE'):
+            updates.append(statement)
+    event.listen(engine, 'before_cursor_execute', note_update)
+    try:
+        for _ in range(3):
+            assert client.post(f'/heartbeat/{token}').status_code == 200
+    finally:
+        event.remove(engine, 'before_cursor_execute', note_update)
+    assert updates == []
+    server.heartbeats.flush()
+    with server.app.app_context():
+        stored = server.db.session.get(server.ExposedInstance, instance_id).last_heartbeat
+    assert stored == server.heartbeats.last_seen(instance_id)
+
+
+# Conditional GETs and compression
+
+def test_unchanged_page_answers_304(client, token, request):
+    url = f'/{request.node.name}/home'
+    first = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert first.status_code == 200
+    assert first.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in first.headers['Vary']
+    again = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+    assert again.data == b''
+
+
+def test_changed_page_is_sent_again(client, token, request):
+    url = f'/{request.node.name}/home'
+    first = client.get(url)
+    assert client.post(f'/heartbeat/{token}', json={'home_data': {'name': 'Ann', 'apps': {}}}).status_code == 200
+    again = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 200
+    assert again.headers['ETag'] != first.headers['ETag']
+
+
+# JSON Patch (RFC 6902)
+
+def test_patch_add_to_object_and_list():
+    doc = {'a': {'b': 1}, 'l': [1, 3]}
+    result = apply_json_patch(doc, [
+        {'op': 'add', 'path': '/a/c', 'value': 2},
+        {'op': 'add', 'path': '/l/1', 'value': 2},
+        {'op': 'add', 'path': '/l/-', 'value': 4},
+    ])
+    assert result == {'a': {'b': 1, 'c': 2}, 'l': [1, 2, 3, 4]}
+    assert doc == {'a': {'b': 1}, 'l': [1, 3]}  # the input is left alone
+
+
+def test_patch_add_replaces_root():
+    assert apply_json_patch({'a': 1}, [{'op': 'add', 'path': '', 'value': [1]}]) == [1]
+
+
+def test_patch_remove_and_replace():
+    doc = {'a': 1, 'b': 2, 'l': [1, 2, 3]}
+    result = apply_json_patch(doc, [
+        {'op': 'remove', 'path': '/a'},
+        {'op': 'remove', 'path': '/l/0'},
+        {'op': 'replace', 'path': '/b', 'value': {'x': 1}},
+        {'op': 'replace', 'path': '/l/1', 'value': 9},
+    ])
+    assert result == {'b': {'x': 1}, 'l': [2, 9]}
+
+
+def test_patch_move_and_copy():
+    doc = {'a': {'x': [1]}, 'b': {}}
+    result = apply_json_patch(doc, [
+        {'op': 'copy', 'from': '/a/x', 'path': '/b/y'},
+        {'op': 'move', 'from': '/a/x', 'path': '/b/z'},
+    ])
+    assert result == {'a': {}, 'b': {'y': [1], 'z': [1]}}
+    result['b']['y'].append(2)
+    assert result['b']['z'] == [1]  # copies do not share values
+
+
+def test_patch_test_operation():
+    doc = {'a': [1, 2]}
+    assert apply_json_patch(doc, [{'op': 'test', 'path': '/a', 'value': [1, 2]}]) == doc
+    with pytest.raises(PatchError):
+        apply_json_patch(doc, [{'op': 'test', 'path': '/a/0', 'value': 2}])
+
+
+def test_patch_pointer_escaping():
+    doc = {'a/b': 1, 'm~n': 2}
+    result = apply_json_patch(doc, [
+        {'op': 'replace', 'path': '/a~1b', 'value': 3},
+        {'op': 'remove', 'path': '/m~0n'},
+        {'op': 'add', 'path': '/~01', 'value': 4},
+    ])
+    assert result == {'a/b': 3, '~1': 4}
+
+
+@pytest.mark.parametrize('operation', [
+    {'op': 'remove', 'path': '/missing'},
+    {'op': 'replace', 'path': '/missing', 'value': 1},
+    {'op': 'add', 'path': '/l/5', 'value': 1},
+    {'op': 'remove', 'path': '/l/-'},
+    {'op': 'add', 'path': '/l/x', 'value': 1},
+    {'op': 'add', 'path': 'no-slash', 'value': 1},
+    {'op': 'remove', 'path': ''},
+    {'op': 'frobnicate', 'path': '/a'},
+    {'op': 'add', 'path': '/a'},
+    {'op': 'move', 'path': '/a'},
+])
+def test_patch_rejects_invalid_operations(operation):
+    with pytest.raises(PatchError):
+        apply_json_patch({'a': 1, 'l': [1]}, [operation])
+
+
+# Delta sync through /register and /heartbeat
+
+def home_hash(client, token):
+    return client.get(f'/sync/{token}').json['snapshots']['home_data']
+
+
+def test_sync_patch_applies_on_matching_base(client, token):
+    response = client.post(f'/heartbeat/{token}', json={'sync': [{
+        'kind': 'home_data', 'base': home_hash(client, token),
+        'patch': [{'op': 'add', 'path': '/apps/b', 'value': 2}]
+    }]})
+    assert response.status_code == 200
+    expected = server.snapshot_digest({'name': 'Ann', 'apps': {'a': 1, 'b': 2}})[1]
+    assert response.json['snapshots']['home_data'] == expected
+
+
+def test_sync_conflicts_return_409_with_current_hashes(client, token):
+    current = home_hash(client, token)
+    response = client.post(f'/heartbeat/{token}', json={'sync': [
+        {'kind': 'home_data', 'base': 'outdated', 'unchanged': True},
+        {'kind': 'nope', 'unchanged': True},
+    ]})
+    assert response.status_code == 409
+    assert [c['error'] for c in response.json['conflicts']] == ['Version mismatch', 'Unknown snapshot kind']
+    assert response.json['conflicts'][0]['current'] == current
+    assert response.json['snapshots']['home_data'] == current
+
+
+def test_sync_rejects_failing_patch_without_writing(client, token):
+    current = home_hash(client, token)
+    response = client.post(f'/heartbeat/{token}', json={'sync': [{
+        'kind': 'home_data', 'base': current,
+        'patch': [{'op': 'replace', 'path': '/apps/a', 'value': 5},
+                  {'op': 'remove', 'path': '/missing'}]
+    }]})
+    assert response.status_code == 409
+
+
+# File downloads
+
+class FakeDownload:
+    """Streamed upstream response of /api/files/download"""
+
+    def __init__(self, status_code, body, headers):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def upstream_download(monkeypatch):
+    """Serve downloads from a FakeDownload; returns (forwarded request, response)"""
+    sent = {}
+    response = FakeDownload(206, b'0123456789', {
+        'Content-Type': 'application/octet-stream', 'Content-Length': '10',
+        'Content-Range': 'bytes 10-19/100', 'Accept-Ranges': 'bytes'
+    })
+
+    def fake_request(instance, path, **kwargs):
+        sent.update(kwargs, path=path)
+        return response
+    monkeypatch.setattr(server, 'upstream_request', fake_request)
+    monkeypatch.setattr(server, 'check_access', lambda instance, request: True)
+    return sent, response
+
+
+def test_download_relays_ranges(client, token, request, upstream_download):
+    sent, upstream_response = upstream_download
+    response = client.get(f'/{request.node.name}/files/download?path=docs/a.bin', headers={
+        'Range': 'bytes=10-19', 'If-Range': '"v1"', 'Accept-Encoding': 'gzip'
+    })
+    assert response.status_code == 206
+    assert sent['path'] == '/api/files/download'
+    assert sent['params'] == {'path': 'docs/a.bin'}
+    assert sent['headers'] == {'Accept-Encoding': 'identity', 'Range': 'bytes=10-19', 'If-Range': '"v1"'}
+    assert sent['stream'] is True
+    assert response.headers['Content-Range'] == 'bytes 10-19/100'
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == b'0123456789'
+
+
+def test_download_releases_its_slot(client, token, request, upstream_download):
+    _, upstream_response = upstream_download
+    instance_id = resolve_token(token)
+    response = client.get(f'/{request.node.name}/files/download?path=a.bin')
+    assert response.data == b'0123456789'
+    response.close()
+    assert upstream_response.closed
+    assert server.download_slots.active(instance_id) == 0
+
+
+def test_download_turns_away_requests_without_a_slot(client, token, request, upstream_download,
+                                                      monkeypatch):
+    monkeypatch.setattr(server.download_slots, 'limit', 0)
+    response = client.get(f'/{request.node.name}/files/download?path=a.bin')
+    assert response.status_code == 429
+    assert response.headers['Retry-After']
+
+
+# File search index
+
+def listing(*names, folders=()):
+    return {'structure': {
+        'folders': [{'name': name} for name in folders],
+        'files': [{'name': name, 'size': '1 KB'} for name in names],
+    }}
+
+
+def search_paths(index, query):
+    return [entry.path for entry in index.search(1, query)]
+
+
+def test_search_matches_substrings_prefixes_first():
+    index = FileSearchIndex()
+    index.load(1, [('', listing('report.pdf', folders=['music'])),
+                   ('music', listing('final_report.mp3', 'song.mp3'))])
+    assert search_paths(index, 'report') == ['report.pdf', 'music/final_report.mp3']
+    assert search_paths(index, 'REP') == ['report.pdf', 'music/final_report.mp3']
+    assert search_paths(index, 'mus') == ['music']
+    assert search_paths(index, 'nothing') == []
+
+
+def test_search_short_queries_match_prefixes():
+    index = FileSearchIndex()
+    index.load(1, [('', listing('song.mp3', 'aso.txt'))])
+    assert search_paths(index, 'so') == ['song.mp3']
+    assert search_paths(index, 's') == ['song.mp3']
+
+
+def test_search_follows_directory_updates():
+    index = FileSearchIndex()
+    index.load(1, [('docs', listing('old.txt', 'keep.txt'))])
+    index.update_directory(1, 'docs', listing('new.txt', 'keep.txt'))
+    assert search_paths(index, 'old') == []
+    assert search_paths(index, 'new') == ['docs/new.txt']
+    assert search_paths(index, 'keep') == ['docs/keep.txt']
+    index.remove_directory(1, 'docs')
+    assert search_paths(index, 'keep') == []
+
+
+def test_search_ignores_instances_not_loaded():
+    index = FileSearchIndex()
+    index.update_directory(1, '', listing('a.txt'))
+    assert not index.is_loaded(1)
+    index.load(1, [('', listing('abc.txt'))])
+    index.forget(1)
+    assert search_paths(index, 'abc') == []
+
+
+def test_search_respects_max_entries():
+    index = FileSearchIndex(max_entries=2)
+    index.load(1, [('', listing('aaa1', 'aaa2', 'aaa3'))])
+    assert len(index.search(1, 'aaa')) == 2
+
+
+# Database writer
+
+def test_writer_undoes_only_the_failing_job(client):
+    gate = threading.Event()
+    blocker = server.db_writer.submit(gate.wait, 5)
+
+    def failing():
+        server.shared_put('writer:bad', {'n': 2})
+        raise ValueError('boom')
+    try:
+        # Queued behind the blocker, so they are written in one transaction
+        futures = [server.db_writer.submit(server.shared_put, 'writer:a', {'n': 1}),
+                   server.db_writer.submit(failing),
+                   server.db_writer.submit(server.shared_put, 'writer:b', {'n': 3})]
+    finally:
+        gate.set()
+    blocker.result(5)
+    assert futures[0].result(5) is None and futures[2].result(5) is None
+    with pytest.raises(ValueError):
+        futures[1].result(5)
+    with server.app.app_context():
+        assert server.shared_get('writer:a').value == {'n': 1}
+        assert server.shared_get('writer:bad') is None
+        assert server.shared_get('writer:b').value == {'n': 3}
+
+
+# Batched heartbeats
+
+def test_batch_returns_a_result_per_heartbeat(client, token):
+    response = client.post('/heartbeat/batch', json={'heartbeats': [
+        {'token': token},
+        {'token': 'unknown'},
+        {'token': token, 'home_data': {'name': 'Bo', 'apps': {}}},
+        {'token': token, 'sync': [{'kind': 'home_data', 'base': 'outdated', 'unchanged': True}]},
+    ]})
+    assert response.status_code == 200
+    results = response.json['results']
+    assert [(r['token'], r['code']) for r in results] == [(token, 200), ('unknown', 404), (token, 200), (token, 409)]
+    assert results[2]['snapshots']['home_data'] == server.snapshot_digest({'name': 'Bo', 'apps': {}})[1]
+    assert results[3]['conflicts'][0]['error'] == 'Version mismatch'
+
+
+def test_batch_rejects_malformed_requests(client):
+    assert client.post('/heartbeat/batch', json={'heartbeats': [{'no': 'token'}]}).status_code == 400
+    too_many = {'heartbeats': [{'token': 'x'}] * (server.app.config['HEARTBEAT_BATCH_MAX'] + 1)}
+    assert client.post('/heartbeat/batch', json=too_many).status_code == 413
+
+
+def test_sync_base_is_checked_against_the_stored_snapshot(client, token):
+    instance_id = resolve_token(token)
+    # Another process stored a newer copy; this one still caches the old one
+    server.db_writer.run(server.store_instance_snapshot, instance_id, 'home_data', {'name': 'Dee'})
+    current = home_hash(client, token)
+    assert current == server.snapshot_digest({'name': 'Dee'})[1]
+    response = client.post(f'/heartbeat/{token}', json={'sync': [
+        {'kind': 'home_data', 'base': current, 'unchanged': True}
+    ]})
+    assert response.status_code == 200
+
+
+def test_batch_rejects_malformed_items_one_by_one(client, token):
+    response = client.post('/heartbeat/batch', json={'heartbeats': [
+        {'token': token, 'sync': 'abc'},
+        {'token': token, 'home_data': {'name': 'Cy'}},
+    ]})
+    assert response.status_code == 200
+    assert [r['code'] for r in response.json['results']] == [400, 200]
+
+
+@pytest.mark.parametrize('body', [[1, 2], 'abc', 3])
+def test_heartbeat_bodies_other_than_objects_are_pings(client, token, body):
+    response = client.post(f'/heartbeat/{token}', json=body)
+    assert response.status_code == 200
+    assert response.json == {'status': 'ok'}
+
+
+
+
+@pytest.mark.parametrize('sync', ['abc', [1], {'kind': 'home_data'}])
+def test_malformed_sync_is_rejected(client, token, sync):
+    response = client.post(f'/heartbeat/{token}', json={'sync': sync})
+    assert response.status_code == 400
+    response = client.post('/register', json={
+        'user_id': 1, 'username': 'malformed', 'local_url': 'http://127.0.0.1:1',
+        'initial_data': {'sync': sync}
+    })
+    assert response.status_code == 400
+    assert 'sync' in response.json['error']
+
+
+# Page status of cached snapshots
+
+def stale_page_status(client, token, username):
+    ttl = server.snapshot_cache.ttl('home_data')
+    synced_at = server.datetime.utcnow() - server.timedelta(seconds=ttl + 1)
+    with server.app.app_context():
+        instance = server.ExposedInstance.query.filter_by(username=username).first()
+        server.snapshot_cache.put(server.snapshot_key(instance.id, 'home_data'), {'name': 'Ann'}, synced_at)
+        return server.fetch_page_data(instance, 'home_data', check_acl=False).status
+
+
+def test_stale_copy_of_reachable_instance_is_refreshing(client, token, request):
+    assert stale_page_status(client, token, request.node.name) == 'stale'
+
+
+def test_stale_copy_of_unreachable_instance_is_offline(client, token, request):
+    instance_id = resolve_token(token)
+    server.breakers.get(instance_id)._open('error')
+    assert stale_page_status(client, token, request.node.name) == 'offline'
+
+
+# Listing windows
+
+def test_windows_of_unpaginated_listing_share_one_fetch(client, token, request, monkeypatch):
+    folder = {'path': 'big', 'structure': {
+        'folders': [], 'files': [{'name': f'f{i:03}.txt', 'size': '1 KB'} for i in range(500)]
+    }}
+    fetched = []
+
+    def fetch(instance, endpoint, params=None, validators=None):
+        fetched.append(params)
+        return server.UpstreamResult(folder, True, False, {})
+    monkeypatch.setattr(server, 'fetch_local_snapshot', fetch)
+    monkeypatch.setattr(server, 'fetch_allowed_users', lambda instance: [])
+
+    username = request.node.name
+    pages = [client.get(f'/{username}/files/rows?path=big&offset={offset}&limit=100&sort=name&order=desc')
+             for offset in (100, 200, 300)]
+    assert [page.status_code for page in pages] == [200, 200, 200]
+    assert [page.headers.get('X-Remaining') for page in pages] == ['300', '200', '100']
+    assert b'f299.txt' in pages[1].data
+    assert len(fetched) == 1
+    instance_id = resolve_token(token)
+    keys = [key for key in server.snapshot_cache._entries if key[0] == instance_id and key[1] == 'files_data']
+    assert keys == [(instance_id, 'files_data', (('path', 'big'),))]
+
+
+def test_repeated_access_lists_skip_the_writer(client, token, monkeypatch):
+    jobs = []
+    run = server.db_writer.run
+    monkeypatch.setattr(server.db_writer, 'run', lambda fn, *args: jobs.append(fn.__name__) or run(fn, *args))
+    for _ in range(5):
+        response = client.post(f'/heartbeat/{token}', json={'acl_version': 'v1', 'allowed_users': ['a@x.org']})
+        assert response.status_code == 200
+    assert jobs == ['share_acl_pushes']
+    assert server.heartbeats.last_seen(resolve_token(token)) is not None
+
+
+# Several worker processes
+
+def relay_from_other_process(instance_id, endpoint, path=None):
+    """Append the 'snapshot' row another process would write, and read the log"""
+    server.invalidations.poll()  # the first poll only notes where the log ends
+    with server.app.app_context():
+        server.db.session.add(server.CacheInvalidation(
+            instance_id=instance_id, scope='snapshot', origin='other-process',
+            detail={'endpoint': endpoint, 'path': path}
+        ))
+        server.db.session.commit()
+    server.invalidations.poll()
+
+
+def test_search_index_follows_folders_other_processes_store(client, token):
+    instance_id = resolve_token(token)
+    with server.app.app_context():
+        server.ensure_search_index(instance_id)
+        data = listing('quarterly-report.pdf')
+        size, content_hash = server.snapshot_digest(data)
+        now = server.datetime.utcnow()
+        server.db.session.add(server.DirectorySnapshot(
+            instance_id=instance_id, path='reports', data=data, size=size, content_hash=content_hash,
+            fetched_at=now, last_access=now
+        ))
+        server.db.session.commit()
+    assert server.file_search.search(instance_id, 'quarterly') == []
+    relay_from_other_process(instance_id, 'files_data', 'reports')
+    assert [entry.path for entry in server.file_search.search(instance_id, 'quarterly')] == \
+        ['reports/quarterly-report.pdf']
+
+
+def test_tabs_get_snapshots_other_processes_store(client, token):
+    instance_id = resolve_token(token)
+    subscription = server.event_broker.subscribe(instance_id)
+    try:
+        with server.app.app_context():
+            content_hash = server.store_instance_snapshot(instance_id, 'home_data', {'name': 'Bob'})
+            server.db.session.commit()
+        relay_from_other_process(instance_id, 'home_data')
+        event = subscription.queue.get(timeout=1)
+    finally:
+        server.event_broker.unsubscribe(instance_id, subscription)
+    assert event.type == 'section'
+    assert event.data['content_hash'] == content_hash
+    assert 'Bob' in event.data['html']
+
+
+def test_single_process_refreshes_without_lease(client, token, request, monkeypatch):
+    def no_lease(name, seconds):
+        raise AssertionError('lease taken')
+    monkeypatch.setattr(server, 'acquire_lease', no_lease)
+    monkeypatch.setattr(server, 'fetch_local_snapshot',
+                        lambda instance, endpoint, params=None, validators=None:
+                        server.UpstreamResult({'name': 'Cy'}, True, False, {}))
+    with server.app.app_context():
+        instance = server.ExposedInstance.query.filter_by(username=request.node.name).first()
+        server.snapshot_cache.put(server.snapshot_key(instance.id, 'home_data'), {'name': 'Ann'},
+                                  server.datetime.utcnow() - server.timedelta(days=1))
+        page = server.fetch_page_data(instance, 'home_data', check_acl=False)
+    assert (page.data, page.status) == ({'name': 'Cy'}, 'online')
+
+
+def test_copy_refreshed_elsewhere_is_not_shown_as_online(client, token, request, monkeypatch):
+    monkeypatch.setitem(server.app.config, 'WORKER_PROCESSES', 2)
+    monkeypatch.setattr(server, 'adopt_stored_snapshot', lambda *args: None)
+    monkeypatch.setattr(server, 'acquire_lease', lambda name, seconds: False)
+    with server.app.app_context():
+        instance = server.ExposedInstance.query.filter_by(username=request.node.name).first()
+        server.snapshot_cache.put(server.snapshot_key(instance.id, 'home_data'), {'name': 'Ann'},
+                                  server.datetime.utcnow() - server.timedelta(days=1))
+        page = server.fetch_page_data(instance, 'home_data', check_acl=False)
+    assert (page.data, page.status) == ({'name': 'Ann'}, 'stale')
+
+
+# Folder eviction order
+
+def directory_last_access(instance_id, path):
+    server.db_writer.run(lambda: None)  # let queued touches land
+    with server.app.app_context():
+        return server.db.session.query(server.DirectorySnapshot.last_access) \
+            .filter_by(instance_id=instance_id, path=path).scalar()
+
+
+def test_folders_served_from_memory_stay_recently_used(client, token, request):
+    instance_id = resolve_token(token)
+    long_ago = server.datetime.utcnow() - server.timedelta(days=1)
+    data = listing('a.txt')
+    server.db_writer.run(server.store_directory, instance_id, 'docs', data, long_ago)
+    server.snapshot_cache.put(server.snapshot_key(instance_id, 'files_data', {'path': 'docs'}), data)
+    with server.app.app_context():
+        instance = server.ExposedInstance.query.filter_by(username=request.node.name).first()
+        server.fetch_page_data(instance, 'files_data', {'path': 'docs'}, check_acl=False)
+    assert directory_last_access(instance_id, 'docs') > long_ago
+
+
+def test_confirmed_folders_stay_recently_used(client, token, request):
+    instance_id = resolve_token(token)
+    long_ago = server.datetime.utcnow() - server.timedelta(days=1)
+    server.db_writer.run(server.store_directory, instance_id, 'docs', listing('a.txt'), long_ago)
+
+    def confirm():
+        instance = server.ExposedInstance.query.filter_by(username=request.node.name).first()
+        server.touch_snapshot(instance, 'files_data', {'path': 'docs'})
+    server.db_writer.run(confirm)
+    assert directory_last_access(instance_id, 'docs') > long_ago
+
+
+# Folder prefetch
+
+def test_prefetches_run_on_their_own_capped_executor(monkeypatch):
+    release = threading.Event()
+    threads = []
+
+    def prefetch(instance, params):
+        threads.append(threading.current_thread().name)
+        release.wait(5)
+        return None, False
+    monkeypatch.setattr(server, 'prefetch_folder', prefetch)
+    prefetcher = server.FolderPrefetcher(children=3, max_concurrent=3, max_total=2)
+    rows = [('folder', {'name': name}) for name in ('a', 'b', 'c')]
+    try:
+        for instance_id in (9001, 9002):
+            prefetcher.after_listing(SimpleNamespace(id=instance_id, username='prefetch'), '', rows)
+        assert prefetcher.started == 2
+    finally:
+        release.set()
+    prefetcher._executor.shutdown(wait=True)
+    assert len(threads) == 2 and all(name.startswith('prefetch') for name in threads)
+    assert prefetcher._take_slot(9002)
+
+
+# Offline instances
+
+def test_offline_instances_are_kept_unless_retention_is_set(monkeypatch):
+    assert server.liveness.retention is None
+    reaped = []
+    monkeypatch.setattr(server, 'reap_dead_instances', lambda retention: reaped.append(retention) or [])
+    monkeypatch.setattr(server.liveness, 'sweep_interval', 0)
+    monkeypatch.setattr(server.liveness, '_reaped_at', 0)
+    sweeps = []
+
+    def sweep():
+        sweeps.append(1)
+        if len(sweeps) > 1:
+            raise SystemExit  # leave the sweeper loop
+    monkeypatch.setattr(server.liveness, 'sweep', sweep)
+    with pytest.raises(SystemExit):
+        server.liveness._run()
+    assert reaped == []
+
+
+# API ETags
+
+def test_api_etag_names_the_content_coding(client, token, request, monkeypatch):
+    monkeypatch.setattr(server, 'fetch_allowed_users', lambda instance: [])
+    instance_id = resolve_token(token)
+    server.snapshot_cache.put(server.snapshot_key(instance_id, 'home_data'),
+                              {'name': 'Ann', 'notes': ['note %d' % i for i in range(300)]})
+    url = f'/api/v1/{request.node.name}/home'
+    plain = client.get(url, headers={'Accept-Encoding': 'identity'})
+    gzipped = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert gzipped.headers['Content-Encoding'] == 'gzip'
+    assert plain.headers['ETag'] != gzipped.headers['ETag']
+    assert client.get(url, headers={'Accept-Encoding': 'gzip',
+                                    'If-None-Match': gzipped.headers['ETag']}).status_code == 304
+    assert client.get(url, headers={'Accept-Encoding': 'identity',
+                                    'If-None-Match': plain.headers['ETag']}).status_code == 304
+    assert client.get(url, headers={'Accept-Encoding': 'identity',
+                                    'If-None-Match': gzipped.headers['ETag']}).status_code == 200